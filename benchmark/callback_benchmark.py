@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8
+#
+# 跨线程add_callback的吞吐量测试：若干工作线程把callback交回IOLoop线程，
+# 分别比较逐个add_callback和批量add_callbacks，以及eventfd和管道两种Waker。
+#
+# python benchmark/callback_benchmark.py
+# python benchmark/callback_benchmark.py --threads=8 --n=200000 --batch=64 --waker=pipe
+
+import threading
+import time
+
+from tornado import ioloop
+from tornado.ioloop import IOLoop
+from tornado.options import define, options, parse_command_line
+
+define("threads", type=int, default=4, help="number of worker threads")
+define("n", type=int, default=100000, help="callbacks posted by each thread")
+define("batch", type=int, default=32, help="batch size for add_callbacks")
+define("waker", default="auto", help="auto, eventfd or pipe")
+define("num_runs", type=int, default=3)
+
+
+def run(mode):
+    if options.waker == "pipe":
+        ioloop._eventfd = None
+    io_loop = IOLoop()
+    if options.waker == "eventfd":
+        assert isinstance(io_loop._waker, ioloop._EventFDWaker), "eventfd is not available"
+    total = options.threads * options.n
+    done = [0]
+
+    def callback():
+        done[0] += 1
+        if done[0] == total:
+            io_loop.stop()
+
+    def worker():
+        if mode == "add_callback":
+            for i in xrange(options.n):
+                io_loop.add_callback(callback)
+        else:
+            batch = [callback] * options.batch
+            for i in xrange(0, options.n, options.batch):
+                io_loop.add_callbacks(batch[:options.n - i])
+
+    threads = [threading.Thread(target=worker) for i in xrange(options.threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    io_loop.start()
+    elapsed = time.time() - start
+    for t in threads:
+        t.join()
+    print "%-14s %-14s %10.0f callbacks/sec" % (
+        mode, type(io_loop._waker).__name__, total / elapsed)
+    io_loop.close()
+
+
+def main():
+    parse_command_line()
+    for i in xrange(options.num_runs):
+        run("add_callback")
+        run("add_callbacks")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8
+#
+# 路由查找的速度测试：比较按顺序逐个regex.match（Application原来的做法）和编译后的_URLRouter。
+# 路由表中一半是固定路径，一半带有参数；分别测试匹配第一个、中间、最后一个路由以及没有匹配的路径。
+#
+# python benchmark/router_benchmark.py
+# python benchmark/router_benchmark.py --routes=1000 --n=20000
+
+import time
+
+from tornado.options import define, options, parse_command_line
+from tornado.web import RequestHandler, URLSpec, _URLRouter
+
+define("routes", type=int, default=500, help="number of routes in the table")
+define("n", type=int, default=50000, help="lookups per path")
+define("num_runs", type=int, default=3)
+
+
+def make_specs(count):
+    specs = []
+    for i in xrange(count):
+        if i % 2:
+            specs.append(URLSpec(r"/api/v1/resource%d/([0-9]+)/(\w+)" % i, RequestHandler))
+        else:
+            specs.append(URLSpec(r"/pages/page%d\.html" % i, RequestHandler))
+    return specs
+
+
+def linear_match(specs, path):
+    for spec in specs:
+        match = spec.regex.match(path)
+        if match:
+            return spec, match
+    return None, None
+
+
+def run(specs, router, name, path):
+    for mode, fn in [("linear", lambda: linear_match(specs, path)),
+                     ("compiled", lambda: router.match(path))]:
+        start = time.time()
+        for i in xrange(options.n):
+            fn()
+        elapsed = time.time() - start
+        print "%-8s %-9s %10.0f lookups/sec" % (name, mode, options.n / elapsed)
+
+
+def main():
+    parse_command_line()
+    specs = make_specs(options.routes)
+    router = _URLRouter(specs)
+    last = options.routes - 1 if (options.routes - 1) % 2 else options.routes - 2
+    paths = [("first", "/pages/page0.html"),
+             ("middle", "/api/v1/resource%d/42/abc" % (options.routes // 2 | 1)),
+             ("last", "/api/v1/resource%d/42/abc" % last),
+             ("miss", "/no/such/page")]
+    for name, path in paths:
+        assert router.match(path)[0] is linear_match(specs, path)[0]
+    for i in xrange(options.num_runs):
+        for name, path in paths:
+            run(specs, router, name, path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+# vim: fileencoding=utf-8
+
+""" 用于在IOLoop线程之外运行阻塞操作（密码hash、图片缩放、阻塞的数据库驱动等）的线程池和进程池。
+通常不直接调用这里的submit，而是使用IOLoop.run_in_executor，它会把结果（或异常）交回到IOLoop线程中：
+
+    pool = ThreadPoolExecutor(max_workers=8)
+
+    class LoginHandler(RequestHandler):
+        @asynchronous
+        @gen.engine
+        def post(self):
+            hashed = yield gen.Task(IOLoop.instance().run_in_executor, pool, bcrypt.hashpw, password, salt)
+            ...
+
+两种池都限制了未完成任务的数量：已经有max_workers + max_queue_size个任务未完成时，submit直接抛出ExecutorQueueFull，
+使过载变成调用方可以处理的背压（比如返回503），而不是无限地占用内存。 """
+
+from __future__ import absolute_import, division, with_statement
+
+import cPickle
+import logging
+import multiprocessing
+import Queue
+import sys
+import threading
+
+
+class ExecutorQueueFull(Exception):
+    """ 池中未完成的任务已经达到上限时由submit抛出。 """
+    pass
+
+
+class _BoundedExecutor(object):
+    """ 记录未完成任务的数量，超过上限时拒绝新任务。 """
+    def __init__(self, max_workers, max_queue_size):
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self._pending = 0 # 已经提交但还没有完成的任务数（包括正在运行的）
+        self._shutdown = False
+        self._lock = threading.Lock()
+
+    def pending(self):
+        """ 返回已提交但还没有完成的任务数。 """
+        return self._pending
+
+    def full(self):
+        """ 再提交任务是否会抛出ExecutorQueueFull。 """
+        return self._pending >= self.max_workers + self.max_queue_size
+
+    def _reserve(self):
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot submit to an executor after shutdown")
+            if self.full():
+                raise ExecutorQueueFull("%d tasks pending" % self._pending)
+            self._pending += 1
+            return self._pending
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+
+
+class ThreadPoolExecutor(_BoundedExecutor):
+    """ 固定大小的线程池。工作线程在需要时才创建，最多max_workers个。 """
+    def __init__(self, max_workers=4, max_queue_size=1024):
+        super(ThreadPoolExecutor, self).__init__(max_workers, max_queue_size)
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def submit(self, fn, args, kwargs, callback):
+        """ 在工作线程中调用fn(*args, **kwargs)，完成后在该工作线程中调用callback(result, exc_info)。
+        fn成功时exc_info为None，否则为sys.exc_info()。 """
+        pending = self._reserve()
+        with self._lock:
+            if len(self._threads) < min(pending, self.max_workers):
+                thread = threading.Thread(target=self._work,
+                                          name="ThreadPoolExecutor-%d" % len(self._threads))
+                thread.daemon = True # 不要因为池没有关闭而阻止进程退出
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put((fn, args, kwargs, callback))
+
+    def shutdown(self, wait=True):
+        """ 关闭线程池。已经提交的任务仍会运行完；wait为True时等待所有工作线程退出。 """
+        with self._lock:
+            self._shutdown = True
+            threads = list(self._threads)
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            fn, args, kwargs, callback = item
+            try:
+                result, exc_info = fn(*args, **kwargs), None
+            except BaseException: # SystemExit等也要交给callback，否则工作线程退出，等待结果的一方永远等不到
+                result, exc_info = None, sys.exc_info()
+            finally:
+                self._release()
+            try:
+                callback(result, exc_info)
+            except Exception:
+                logging.error("Exception in executor callback %r", callback, exc_info=True)
+
+
+class ProcessPoolExecutor(_BoundedExecutor):
+    """ 基于multiprocessing.Pool的进程池，用于CPU密集的任务。
+    fn、参数和返回值都必须能被pickle（比如模块级的函数）。子进程在构造时就会fork出来，
+    所以应该在创建IOLoop和打开socket之前构造进程池。 """
+    def __init__(self, max_workers=None, max_queue_size=1024):
+        max_workers = max_workers or multiprocessing.cpu_count()
+        super(ProcessPoolExecutor, self).__init__(max_workers, max_queue_size)
+        self._pool = multiprocessing.Pool(max_workers)
+
+    def submit(self, fn, args, kwargs, callback):
+        """ 在子进程中调用fn(*args, **kwargs)，完成后在池的结果处理线程中调用callback(result, exc_info)。
+        traceback不能跨进程传递，所以失败时exc_info的第三项为None（子进程中会把完整的traceback写到日志里）。
+        fn或者参数不能被pickle时直接抛出异常；返回值或异常不能被pickle时，callback收到的是描述这个错误的异常。 """
+        # 在这里就pickle好任务：不能pickle时马上报告给调用方，否则multiprocessing只会把错误记在结果里，
+        # 而python2.7的apply_async没有error_callback，callback永远不会被调用
+        task = cPickle.dumps((fn, args, kwargs), cPickle.HIGHEST_PROTOCOL)
+        self._reserve()
+
+        def on_result(value):
+            self._release()
+            try:
+                ok, payload = cPickle.loads(value)
+            except Exception:
+                ok, payload = False, sys.exc_info()[1]
+            try:
+                if ok:
+                    callback(payload, None)
+                else:
+                    callback(None, (type(payload), payload, None))
+            except Exception: # 不能让异常杀掉池的结果处理线程
+                logging.error("Exception in executor callback %r", callback, exc_info=True)
+        # 结果同样在子进程中pickle好，作为字符串返回，所以multiprocessing本身的pickle不会失败，on_result总会被调用
+        self._pool.apply_async(_call_in_process, (task,), callback=on_result)
+
+    def shutdown(self, wait=True):
+        """ 关闭进程池。已经提交的任务仍会运行完；wait为True时等待所有子进程退出。 """
+        with self._lock:
+            self._shutdown = True
+        self._pool.close()
+        if wait:
+            self._pool.join()
+
+
+def _call_in_process(task):
+    """ 在子进程中运行task（pickle过的(fn, args, kwargs)），返回pickle过的(True, 结果)或(False, 异常对象)。 """
+    fn = None
+    try:
+        fn, args, kwargs = cPickle.loads(task)
+        value = True, fn(*args, **kwargs)
+    except BaseException, e: # SystemExit等也要交回给调用方，否则这个任务的callback永远不会被调用
+        logging.error("Exception in process pool task %r", fn, exc_info=True)
+        value = False, e
+    try:
+        return cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    except Exception, e:
+        what = "result" if value[0] else "exception %r" % value[1]
+        return cPickle.dumps((False, RuntimeError("Could not pickle %s of %r: %s" % (what, fn, e))),
+                             cPickle.HIGHEST_PROTOCOL)
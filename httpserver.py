@@ -2,8 +2,10 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import collections
 import Cookie
 import logging
+import re
 import socket
 import time
 
@@ -21,15 +23,51 @@ except ImportError:
 
 
 class HTTPServer(TCPServer):
-    """ 非阻塞、单线程的HTTP服务器。 """
-    def __init__(self, request_callback, no_keep_alive=False, io_loop=None, xheaders=False, ssl_options=None, **kwargs):
+    """ 非阻塞、单线程的HTTP服务器。
+    如果request_callback有streams_request_body(request)方法，收到带有请求体的请求的header后会先调用它，返回True时
+    不再把请求体读到内存中，而是马上调用request_callback，由它通过request.connection.read_body以流的方式读取请求体。
+    请求体可以用Content-Length或者Transfer-Encoding: chunked发送。max_body_size限制请求体的大小（默认为：
+    读到内存中时是IOStream的max_buffer_size，以流的方式读取时不限制），max_chunk_size限制chunked请求体中每一块的大小。
+    max_headers和max_header_line_length限制请求中header的行数和请求行、每一行header的长度，超过时关闭连接；
+    整个请求头在读取时就被限制在这两者允许的最大长度之内，不会先把任意长的数据读到内存中。
+    支持HTTP/1.1的流水线（pipelining）：一个请求的请求体读完之后就开始读取并处理同一个连接上的下一个请求，
+    响应仍然严格按照请求的顺序发送。只有GET、HEAD、OPTIONS这些安全的方法会与前面的请求并行处理，其它请求要等前面的
+    请求都结束之后才交给request_callback，它之后的请求也要等它结束。max_pipeline_depth是一个连接上同时处理的请求数的上限，为1时不使用流水线。
+    以下几个限制（单位为秒，默认为None即不限制）超过时关闭连接，防止空闲或者很慢的客户端一直占用fd和内存：
+    idle_connection_timeout是连接上没有请求时等待下一个请求的时间，超时时如果已经收到了请求的一部分，
+    改为再等待header_read_timeout（没有设置idle_connection_timeout时从开始等待请求起计算）；
+    body_read_timeout是读取请求体时允许没有收到任何数据的最长时间。max_requests_per_connection是一个连接上最多
+    处理的请求数，最后一个请求的响应之后关闭连接。这些定时器都使用IOLoop.add_timeout，连接很多时可以让IOLoop使用TimingWheel。 """
+    def __init__(self, request_callback, no_keep_alive=False, io_loop=None, xheaders=False, ssl_options=None,
+                 max_body_size=None, max_chunk_size=None, max_headers=100, max_header_line_length=8192,
+                 max_pipeline_depth=16, idle_connection_timeout=None, header_read_timeout=None,
+                 body_read_timeout=None, max_requests_per_connection=None, **kwargs):
         self.request_callback = request_callback # 在使用时，基本上该对象都是web.Application对象
         self.no_keep_alive = no_keep_alive
         self.xheaders = xheaders
+        self.max_body_size = max_body_size
+        self.max_chunk_size = max_chunk_size
+        self.max_headers = max_headers
+        self.max_header_line_length = max_header_line_length
+        self.max_pipeline_depth = max_pipeline_depth
+        self.idle_connection_timeout = idle_connection_timeout
+        self.header_read_timeout = header_read_timeout
+        self.body_read_timeout = body_read_timeout
+        self.max_requests_per_connection = max_requests_per_connection
         TCPServer.__init__(self, io_loop=io_loop, ssl_options=ssl_options, **kwargs)
 
     def handle_stream(self, stream, address): # stream由TCPServer封装
-        HTTPConnection(stream, address, self.request_callback, self.no_keep_alive, self.xheaders)
+        HTTPConnection(stream, address, self.request_callback, self.no_keep_alive, self.xheaders,
+                       max_body_size=self.max_body_size, max_chunk_size=self.max_chunk_size,
+                       max_headers=self.max_headers, max_header_line_length=self.max_header_line_length,
+                       max_pipeline_depth=self.max_pipeline_depth,
+                       idle_connection_timeout=self.idle_connection_timeout,
+                       header_read_timeout=self.header_read_timeout, body_read_timeout=self.body_read_timeout,
+                       max_requests_per_connection=self.max_requests_per_connection)
+
+
+_CHUNK_SIZE_RE = re.compile(b("^[0-9a-fA-F]+$"))
+_SAFE_METHODS = frozenset(["GET", "HEAD", "OPTIONS"]) # 流水线中可以与前面的请求并行处理的方法
 
 
 class _BadRequestException(Exception):
@@ -39,80 +77,375 @@ class _BadRequestException(Exception):
 
 class HTTPConnection(object):
     """ 处理HTTP客户端的连接，执行HTTP请求。 """
-    def __init__(self, stream, address, request_callback, no_keep_alive=False, xheaders=False):
+    def __init__(self, stream, address, request_callback, no_keep_alive=False, xheaders=False,
+                 max_body_size=None, max_chunk_size=None, max_headers=100, max_header_line_length=8192,
+                 max_pipeline_depth=16, idle_connection_timeout=None, header_read_timeout=None,
+                 body_read_timeout=None, max_requests_per_connection=None):
         self.stream = stream
         self.address = address
         self.request_callback = request_callback
         self.no_keep_alive = no_keep_alive
         self.xheaders = xheaders
-        self._request = None
-        self._request_finished = False
+        self.max_body_size = max_body_size
+        self.max_chunk_size = max_chunk_size
+        self.max_headers = max_headers
+        self.max_header_line_length = max_header_line_length
+        self.max_pipeline_depth = max_pipeline_depth
+        self.idle_connection_timeout = idle_connection_timeout
+        self.header_read_timeout = header_read_timeout
+        self.body_read_timeout = body_read_timeout
+        self.max_requests_per_connection = max_requests_per_connection
+        self._num_requests = 0
+        self._request = None # 最近一个读到header的请求，它的请求体可能还在读取中
+        # 还没有结束的请求的响应（_PipelinedResponse），按请求的顺序排列，只有第一个的输出直接写入到流中
+        self._responses = collections.deque()
+        self._reading_headers = False
+        self._last_request = False # 已经读到的最后一个请求结束后要关闭连接，不再读取新的请求
+        self._upgrade_pending = False # 有一个带Upgrade header的请求还没有结束，它可能会接管stream，在那之前不读取新的请求
+        self._write_callback = None
         # 在这里（任何请求之外）保存stack context。这样防止了contexts从一个请求泄漏到下一个。
         self._header_callback = stack_context.wrap(self._on_headers)
-        self.stream.read_until(b("\r\n\r\n"), self._header_callback) # 以\r\n\r\n来分隔header和body
-        self._write_callback = None
+        self._timeout_callback = stack_context.wrap(self._on_timeout)
+        self._timeout = None # IOLoop.add_timeout返回的句柄，同一时间最多只有一个定时器
+        self._timeout_kind = None # "idle"、"header"或"body"
+        self._body_progress = None # 上一次检查请求体超时时已经收到的数据量
+        self._body_received = 0 # 已经交给data_callback的请求体字节数
+        self.stream.set_close_callback(stack_context.wrap(self._on_connection_close))
+        # 以流的方式读取请求体（见read_body）或者读取chunked请求体时的状态
+        self._body_pending = False # 请求体还没有读完
+        self._body_remaining = 0 # 还没有读取的请求体（chunked时为当前这一块）字节数
+        self._chunked = False
+        self._chunk_crlf = False # 当前这一块的数据之后还有一个CRLF没有读
+        self._body_size = 0 # chunked请求体到目前为止的大小
+        self._trailer_lines = 0 # 已经读到的trailer行数
+        self._body_limit = None
+        self._data_callback = None
+        self._body_callback = None
+        self._body_chunk_size = None
+        self._body_as_view = False
+        self._body_paused = False
+        self._in_data_callback = False
+        self._read_headers()
 
     def close(self):
+        self._clear_timeout()
         self.stream.close()
         self._header_callback = None # 把引用删除，防止循环引用和垃圾收集延迟
 
-    def write(self, chunk, callback=None):
-        """ 把一块数据写入到流中。 """
-        assert self._request, "Request closed"
-        if not self.stream.closed():
-            self._write_callback = stack_context.wrap(callback)
-            self.stream.write(chunk, self._on_write_complete)
-
-    def finish(self):
-        """ 完成这个请求。 """
-        assert self._request, "Request closed"
-        self._request_finished = True
-        if not self.stream.writing():
+    def write(self, chunk, callback=None, request=None):
+        """ 把一块数据写入到流中。
+        request是这块数据所属的请求，为None时是最早的还没有结束的请求（不使用流水线时也就是唯一的请求）。
+        前面还有没有结束的请求时，数据会先缓存起来，等前面的响应都发送完之后再写入，callback也在那时才调用。 """
+        response = self._get_response(request)
+        self._write(response, (chunk,), stack_context.wrap(callback))
+
+    def write_file(self, fileobj, offset, count, callback=None, request=None):
+        """ 把文件的一段写入到流中（见IOStream.write_file），request的含义与write相同。 """
+        response = self._get_response(request)
+        self._write(response, (fileobj, offset, count), stack_context.wrap(callback))
+
+    def finish(self, request=None):
+        """ 完成这个请求，request的含义与write相同。 """
+        response = self._get_response(request)
+        response.finished = True
+        if response is self._responses[0] and not self.stream.writing():
             self._finish_request()
 
+    def set_close_callback(self, callback, request=None):
+        """ 连接关闭时调用callback()，request的含义与write相同。
+        流水线中的每个请求都有自己的callback，请求结束后它的callback就不会再被调用。 """
+        self._get_response(request).close_callback = stack_context.wrap(callback)
+
+    def _get_response(self, request):
+        if request is None:
+            assert self._responses, "Request closed"
+            return self._responses[0]
+        for response in self._responses:
+            if response.request is request:
+                return response
+        raise AssertionError("Request closed")
+
+    def _write(self, response, args, callback):
+        if self.stream.closed():
+            return
+        if response is not self._responses[0]:
+            response.writes.append((args, callback))
+            return
+        self._write_callback = callback
+        if len(args) == 1:
+            if response.upgrade and args[0][:9] in (b("HTTP/1.1 "), b("HTTP/1.0 ")) and args[0][9:12] == b("101"):
+                response.switched_protocols = True
+            self.stream.write(args[0], self._on_write_complete)
+        else:
+            self.stream.write_file(args[0], args[1], args[2], self._on_write_complete)
+
+    def _on_connection_close(self):
+        self._clear_timeout()
+        for response in list(self._responses):
+            if response.close_callback is not None:
+                callback = response.close_callback
+                response.close_callback = None
+                callback()
+
+    def read_body(self, data_callback, callback, chunk_size=64 * 1024, as_view=False):
+        """ 以流的方式读取当前请求（request.body_streaming为True）的请求体：每读到最多chunk_size字节调用一次
+        data_callback(chunk)，全部读完后调用callback()。上一块交给data_callback之后才会读下一块，
+        所以内存中最多只有一块请求体。处理得慢时可以调用pause_reading暂停读取，之后再调用resume_reading。
+        as_view为True时chunk是IOStream读buffer的memoryview（见IOStream.read_bytes），不再复制成字符串，
+        适合直接写到文件或者socket的情况；需要字符串时调用chunk.tobytes()。 """
+        assert self._request and self._request.body_streaming, "Request body is not streamed"
+        self._read_body(stack_context.wrap(data_callback), stack_context.wrap(callback), chunk_size, as_view)
+
+    def _read_body(self, data_callback, callback, chunk_size, as_view=False):
+        self._data_callback = data_callback
+        self._body_callback = callback
+        self._body_chunk_size = chunk_size
+        self._body_as_view = as_view
+        self._read_body_chunk()
+
+    def pause_reading(self):
+        """ 交给data_callback的这一块处理完之前不再读取请求体，暂停期间对端会因为TCP的流量控制而暂停发送。 """
+        self._body_paused = True
+
+    def resume_reading(self):
+        """ 继续读取被pause_reading暂停的请求体。 """
+        if not self._body_paused:
+            return
+        self._body_paused = False
+        if self._data_callback is not None and not self._in_data_callback and not self.stream.closed():
+            self._read_body_chunk()
+
+    def _read_body_chunk(self):
+        if self._body_remaining:
+            self.stream.read_bytes(min(self._body_remaining, self._body_chunk_size), self._on_body_chunk,
+                                   as_view=self._body_as_view)
+        elif self._chunked and self._body_pending:
+            self._read_chunk_line(self._on_chunk_length)
+        else:
+            self._body_pending = False
+            self._clear_timeout()
+            callback = self._body_callback
+            self._data_callback = self._body_callback = None
+            callback()
+            self._read_headers() # 请求体已经读完，可以开始读取流水线中的下一个请求
+
+    def _on_chunk_length(self, data):
+        if self._chunk_crlf: # 上一块的数据之后的CRLF
+            self._chunk_crlf = False
+            if data != b("\r\n"):
+                self._bad_body("missing CRLF after chunk")
+                return
+            self._read_body_chunk()
+            return
+        size = data[:-2].split(b(";"), 1)[0].strip() # 忽略chunk-extension
+        if not _CHUNK_SIZE_RE.match(size): # int(size, 16)还会接受0x、+、-等前缀
+            self._bad_body("invalid chunk size %r" % data[:-2][:32])
+            return
+        size = int(size, 16)
+        if self.max_chunk_size is not None and size > self.max_chunk_size:
+            self._bad_body("chunk too large")
+            return
+        self._body_size += size
+        if self._body_limit is not None and self._body_size > self._body_limit:
+            self._bad_body("body too large")
+            return
+        if size == 0:
+            self._trailer_lines = 0
+            self._read_chunk_line(self._on_chunk_trailer)
+            return
+        self._body_remaining = size
+        self._chunk_crlf = True
+        self._read_body_chunk()
+
+    def _on_chunk_trailer(self, data):
+        # 最后一块之后是可选的trailer header（这里不使用），以空行结束
+        if data == b("\r\n"):
+            self._body_pending = False
+            self._read_body_chunk()
+            return
+        self._trailer_lines += 1
+        if self._trailer_lines > self.max_headers:
+            self._bad_body("too many trailer lines")
+            return
+        self._read_chunk_line(self._on_chunk_trailer)
+
+    def _read_chunk_line(self, callback):
+        """ 读取chunk-size行或者trailer行，与header一样受max_header_line_length限制，超过时IOStream会关闭连接。 """
+        self.stream.read_until(b("\r\n"), callback, max_bytes=self.max_header_line_length + 2)
+
+    def _bad_body(self, message):
+        logging.info("Malformed HTTP request body from %s: %s", self.address[0], message)
+        self.close()
+
+    def _on_body_chunk(self, chunk):
+        self._body_remaining -= len(chunk)
+        self._body_received += len(chunk)
+        self._in_data_callback = True
+        try:
+            self._data_callback(chunk)
+        finally:
+            self._in_data_callback = False
+        if self._request is None or self.stream.closed(): # handler在data_callback中已经结束了请求
+            return
+        if self._body_paused:
+            self.stream.pause_reading() # 不要让iostream继续把数据读进它的缓冲区
+        else:
+            self._read_body_chunk()
+
     def _on_write_complete(self):
-        if self._write_callback is not None:
+        # 与下面_finish_request的情况相同：这次通知之后可能又写入了数据，那么_write_callback（属于后来的写）
+        # 要等下一次_on_write_complete再调用
+        if self._write_callback is not None and not self.stream.writing():
             callback = self._write_callback
             self._write_callback = None
             callback()
         # _on_write_complete is enqueued on the IOLoop whenever the IOStream's write buffer becomes empty, but it's possible
         # for another callback that runs on the IOLoop before it to simultaneously write more data and finish the request.
         # If there is still data in the IOStream, a future _on_write_complete will be responsible for calling _finish_request.
-        if self._request_finished and not self.stream.writing():
+        if self._responses and self._responses[0].finished and not self.stream.writing():
             self._finish_request()
 
+    def _should_close(self, request):
+        """ 这个请求结束之后是否要关闭连接。 """
+        if self.no_keep_alive or request.close_connection:
+            return True
+        connection_header = request.headers.get("Connection")
+        if connection_header is not None:
+            connection_header = connection_header.lower()
+        if request.supports_http_1_1():
+            return connection_header == "close"
+        elif "Content-Length" in request.headers or request.method in ("HEAD", "GET"):
+            return connection_header != "keep-alive"
+        return True
+
     def _finish_request(self):
-        if self.no_keep_alive:
-            disconnect = True
-        else:
-            connection_header = self._request.headers.get("Connection")
-            if connection_header is not None:
-                connection_header = connection_header.lower()
-            if self._request.supports_http_1_1():
-                disconnect = connection_header == "close"
-            elif "Content-Length" in self._request.headers or self._request.method in ("HEAD", "GET"):
-                disconnect = connection_header != "keep-alive"
-            else:
+        response = self._responses.popleft()
+        request = response.request
+        disconnect = self._should_close(request)
+        if response.upgrade:
+            if response.switched_protocols:
+                # 连接已经切换到了另一个协议，不再属于HTTP，也不能由这里关闭
+                self._last_request = True
+                return
+            self._upgrade_pending = False # 没有升级协议，像普通的请求一样继续读取下一个请求
+        if request is self._request:
+            if self._body_pending:
+                # handler没有读完以流的方式读取的请求体就结束了请求，剩下的数据无法与下一个请求区分开
                 disconnect = True
-        self._request = None
-        self._request_finished = False
+            self._body_pending = False
+            self._body_remaining = 0
+            self._chunked = self._chunk_crlf = False
+            self._body_size = 0
+            self._data_callback = self._body_callback = None
+            self._body_paused = False
+            self._request = None
+            if self._timeout_kind == "body":
+                self._clear_timeout()
         if disconnect:
             self.close()
             return
-        self.stream.read_until(b("\r\n\r\n"), self._header_callback)
+        self._read_headers()
+        if self._responses:
+            self._start_response(self._responses[0])
+
+    def _start_response(self, response):
+        """ response成为第一个没有结束的请求：把缓存的输出写入到流中。 """
+        if response.deferred:
+            if self.stream.closed():
+                return
+            response.deferred = False
+            if response.request is self._request and self._body_pending and self.body_read_timeout is not None:
+                self._body_progress = self._body_received + self.stream._read_buffer_size
+                self._set_timeout("body", self.body_read_timeout)
+            self.request_callback(response.request)
+            if not self._responses or self._responses[0] is not response: # 已经结束了
+                return
+        writes, response.writes = response.writes, []
+        for args, callback in writes:
+            self._write(response, args, callback)
+        if response.finished and not self.stream.writing():
+            self._finish_request()
+
+    def _read_headers(self):
+        """ 在没有读完的请求体、流水线没有满并且连接不会在之前的请求结束后关闭时，开始读取下一个请求的header。 """
+        if not self._reading_headers:
+            if (self._body_pending or self._last_request or self._upgrade_pending or self.stream.closed() or
+                len(self._responses) >= self.max_pipeline_depth):
+                return
+            self._reading_headers = True
+            # 以\r\n\r\n来分隔header和body，请求行加上max_headers行header（各自带CRLF）之后还没有读到空行时关闭连接
+            max_head_size = (self.max_headers + 1) * (self.max_header_line_length + 2) + 2
+            self.stream.read_until(b("\r\n\r\n"), self._header_callback, max_bytes=max_head_size)
+        if not self._responses and self._timeout is None:
+            # 之前的请求都已经结束，开始计算空闲时间（流水线中还有请求时客户端可能在等待响应，不算空闲）
+            if self.idle_connection_timeout is not None and not self.stream._read_buffer_size:
+                self._set_timeout("idle", self.idle_connection_timeout)
+            elif self.header_read_timeout is not None:
+                self._set_timeout("header", self.header_read_timeout)
+
+    def _set_timeout(self, kind, seconds):
+        self._clear_timeout()
+        self._timeout_kind = kind
+        self._timeout = self.stream.io_loop.add_timeout(time.time() + seconds, self._timeout_callback)
+
+    def _clear_timeout(self):
+        if self._timeout is not None:
+            self.stream.io_loop.remove_timeout(self._timeout)
+            self._timeout = self._timeout_kind = None
+
+    def _on_timeout(self):
+        kind = self._timeout_kind
+        self._timeout = self._timeout_kind = None
+        if self.stream.closed():
+            return
+        if kind == "idle":
+            if self.stream._read_buffer_size: # 已经开始收到下一个请求
+                if self.header_read_timeout is not None:
+                    self._set_timeout("header", self.header_read_timeout)
+                return
+            self.close()
+        elif kind == "header":
+            logging.info("Timeout reading HTTP request headers from %s", self.address[0])
+            self.close()
+        elif kind == "body" and self._body_pending:
+            progress = self._body_received + self.stream._read_buffer_size
+            if progress != self._body_progress or self._body_paused: # 数据还在到达，或者是handler暂停了读取
+                self._body_progress = progress
+                self._set_timeout("body", self.body_read_timeout)
+                return
+            logging.info("Timeout reading HTTP request body from %s", self.address[0])
+            self.close()
+
+    def _dispatch(self, request):
+        response = self._responses[-1]
+        if response is not self._responses[0] and not self._can_dispatch_early(response):
+            # 等它成为第一个没有结束的请求时再由_start_response交给request_callback
+            response.deferred = True
+            if self._body_pending: # 以流的方式读取的请求体要等handler调用read_body，在那之前不计算超时
+                self._clear_timeout()
+            return
+        self.request_callback(request)
+
+    def _can_dispatch_early(self, response):
+        """ 前面还有没有结束的请求时，response的请求能否马上交给request_callback。
+        按RFC 7230 6.3.2，只有安全的方法（GET、HEAD、OPTIONS）可以并行处理，所以它和前面所有还在处理的请求都必须是
+        安全的方法；升级协议（如websocket）的请求会直接使用stream，要等前面的响应都发送完。 """
+        request = response.request
+        if "Upgrade" in request.headers or request.method not in _SAFE_METHODS:
+            return False
+        for earlier in self._responses:
+            if earlier is response:
+                break
+            if earlier.deferred or (not earlier.finished and earlier.request.method not in _SAFE_METHODS):
+                return False
+        return True
 
     def _on_headers(self, data):
+        self._reading_headers = False
+        self._clear_timeout()
         try:
-            data = native_str(data.decode('latin1'))
-            eol = data.find("\r\n")
-            start_line = data[:eol]
-            try:
-                method, uri, version = start_line.split(" ")
-            except ValueError:
-                raise _BadRequestException("Malformed HTTP request line")
-            if not version.startswith("HTTP/"):
-                raise _BadRequestException("Malformed HTTP version in HTTP Request-Line")
-            headers = httputil.HTTPHeaders.parse(data[eol:])
+            method, uri, version, headers = httputil.parse_request_head(
+                data, self.max_headers, self.max_header_line_length)
 
             # HTTPRequest wants an IP, not a full socket address
             if getattr(self.stream.socket, 'family', socket.AF_INET) in (socket.AF_INET, socket.AF_INET6):
@@ -123,28 +456,89 @@ class HTTPConnection(object):
                 remote_ip = '0.0.0.0'
 
             self._request = HTTPRequest(connection=self, method=method, uri=uri, version=version, headers=headers, remote_ip=remote_ip)
+            self._responses.append(_PipelinedResponse(self._request))
+            self._num_requests += 1
+            if self.max_requests_per_connection is not None and self._num_requests >= self.max_requests_per_connection:
+                self._request.close_connection = True
+            if self._should_close(self._request):
+                self._last_request = True
+            if "Upgrade" in headers:
+                self._responses[-1].upgrade = self._upgrade_pending = True
 
             content_length = headers.get("Content-Length")
-            if content_length:
-                content_length = int(content_length)
-                if content_length > self.stream.max_buffer_size:
+            transfer_encoding = headers.get("Transfer-Encoding")
+            chunked = transfer_encoding is not None
+            if chunked:
+                # 同时带有Content-Length，或者chunked不是唯一的编码时，不同的服务器（代理）对请求体的边界可能有不同的理解，
+                # 在同一个连接上继续读取请求会被利用来夹带请求（request smuggling），所以直接拒绝
+                if content_length is not None:
+                    raise _BadRequestException("Both Transfer-Encoding and Content-Length")
+                if transfer_encoding.strip().lower() != "chunked":
+                    raise _BadRequestException("Unsupported Transfer-Encoding %r" % transfer_encoding)
+            if content_length or chunked:
+                if not chunked:
+                    if not content_length.isdigit():
+                        raise _BadRequestException("Malformed Content-Length %r" % content_length)
+                    content_length = int(content_length)
+                streams_request_body = getattr(self.request_callback, "streams_request_body", None)
+                streaming = streams_request_body is not None and streams_request_body(self._request)
+                body_limit = self.max_body_size
+                if body_limit is None and not streaming:
+                    body_limit = self.stream.max_buffer_size
+                if content_length is not None and body_limit is not None and content_length > body_limit:
                     raise _BadRequestException("Content-Length too long")
                 if headers.get("Expect") == "100-continue":
-                    self.stream.write(b("HTTP/1.1 100 (Continue)\r\n\r\n"))
-                self.stream.read_bytes(content_length, self._on_request_body) # 100，继续读
+                    self._write(self._responses[-1], (b("HTTP/1.1 100 (Continue)\r\n\r\n"),), None)
+                self._body_pending = True
+                if self.body_read_timeout is not None:
+                    self._body_received = 0
+                    self._body_progress = self.stream._read_buffer_size
+                    self._set_timeout("body", self.body_read_timeout)
+                if not streaming and not chunked:
+                    self.stream.read_bytes(content_length, self._on_request_body) # 100，继续读
+                    return
+                self._body_remaining = content_length or 0
+                self._chunked = chunked
+                self._body_limit = body_limit
+                if streaming:
+                    # 请求体不经过缓冲，由request_callback通过read_body读取，所以也不受max_buffer_size限制
+                    self._request.body_streaming = True
+                    self._dispatch(self._request)
+                    return
+                # chunked请求体全部读完并拼接起来之后，与Content-Length的情况一样交给_on_request_body
+                chunks = []
+                self._read_body(chunks.append, lambda: self._on_request_body(b("").join(chunks)), body_limit)
                 return
 
-            self.request_callback(self._request) # 构建一个HttpReqeust对象，丢给request_callback，即web.Application对象
-        except _BadRequestException, e:
+            self._dispatch(self._request) # 构建一个HttpReqeust对象，丢给request_callback，即web.Application对象
+            self._read_headers()
+        except (_BadRequestException, httputil.HTTPInputError), e:
             logging.info("Malformed HTTP request from %s: %s", self.address[0], e)
             self.close()
             return
 
     def _on_request_body(self, data):
+        self._clear_timeout()
         self._request.body = data
         if self._request.method in ("POST", "PATCH", "PUT"):
             httputil.parse_body_arguments(self._request.headers.get("Content-Type", ""), data, self._request.arguments, self._request.files)
-        self.request_callback(self._request)
+        self._body_pending = False
+        self._dispatch(self._request)
+        self._read_headers()
+
+
+class _PipelinedResponse(object):
+    """ 流水线中一个请求的响应的状态。 """
+    __slots__ = ("request", "writes", "finished", "deferred", "close_callback", "upgrade", "switched_protocols")
+
+    def __init__(self, request):
+        self.request = request
+        self.writes = [] # 成为第一个请求之前写入的数据：[((chunk,)或(fileobj, offset, count), callback)]
+        self.finished = False
+        self.deferred = False # 还没有交给request_callback
+        self.close_callback = None
+        self.upgrade = False # 请求带有Upgrade header
+        self.switched_protocols = False # 响应是101 Switching Protocols
 
 
 class HTTPRequest(object):
@@ -175,7 +569,10 @@ class HTTPRequest(object):
                 self.protocol = "http"
         self.host = host or self.headers.get("Host") or "127.0.0.1"
         self.files = files or {}
+        self.body_streaming = False # 为True时请求体不在body中，要通过connection.read_body读取
+        self.close_connection = False # 为True时服务器会在这个请求的响应之后关闭连接（比如达到了max_requests_per_connection）
         self.connection = connection
+        self.route = None # web.Application为这个请求查找到的路由，streams_request_body和__call__共用，只查找一次
         self._start_time = time.time()
         self._finish_time = None
 
@@ -206,11 +603,15 @@ class HTTPRequest(object):
     def write(self, chunk, callback=None):
         """Writes the given chunk to the response stream."""
         assert isinstance(chunk, bytes_type)
-        self.connection.write(chunk, callback=callback)
+        self.connection.write(chunk, callback=callback, request=self)
+
+    def write_file(self, fileobj, offset, count, callback=None):
+        """Writes count bytes of fileobj, starting at offset, to the response stream."""
+        self.connection.write_file(fileobj, offset, count, callback=callback, request=self)
 
     def finish(self):
         """Finishes this HTTP request on the open connection."""
-        self.connection.finish()
+        self.connection.finish(request=self)
         self._finish_time = time.time()
 
     def full_url(self):
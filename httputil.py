@@ -3,6 +3,7 @@
 from __future__ import absolute_import, division, with_statement
 
 import logging
+import tempfile
 import urllib
 import re
 
@@ -17,6 +18,13 @@ class HTTPHeaders(dict):
     add() and get_list().  The regular dictionary interface returns a single
     value per key, with multiple values joined by a comma.
 
+    Every header line is kept in a single list of (name, value) pairs in
+    the order it was added; the dictionary itself holds the joined value
+    for each name, and the positions of each name in the list are only
+    indexed when `get_list` or a replacement needs them.  `copy` is
+    copy-on-write: the copy shares the list with the original until either
+    of them is modified.
+
     >>> h = HTTPHeaders({"content-type": "text/html"})
     >>> h.keys()
     ['Content-Type']
@@ -41,13 +49,17 @@ class HTTPHeaders(dict):
         # Don't pass args or kwargs to dict.__init__, as it will bypass
         # our __setitem__
         dict.__init__(self)
-        self._as_list = {}
-        self._last_key = None
+        self._pairs = [] # 按加入的顺序保存的(规范化的名字, 值)，get_all和get_list以它为准
+        self._index = None # 名字 -> 该名字在_pairs中的所有位置，需要时才构建，删除时被丢弃
+        self._shared = False # _pairs和_index是否与copy出来的其它对象共用
         if (len(args) == 1 and len(kwargs) == 0 and
             isinstance(args[0], HTTPHeaders)):
             # Copy constructor
-            for k, v in args[0].get_all():
-                self.add(k, v)
+            other = args[0]
+            dict.update(self, other)
+            self._pairs = other._pairs
+            self._index = other._index
+            self._shared = other._shared = True
         else:
             # Dict-style initialization
             self.update(*args, **kwargs)
@@ -57,28 +69,43 @@ class HTTPHeaders(dict):
     def add(self, name, value):
         """Adds a new value for the given key."""
         norm_name = HTTPHeaders._normalize_name(name)
-        self._last_key = norm_name
-        if norm_name in self:
-            # bypass our override of __setitem__ since it modifies _as_list
-            dict.__setitem__(self, norm_name, self[norm_name] + ',' + value)
-            self._as_list[norm_name].append(value)
-        else:
-            self[norm_name] = value
+        self._unshare()
+        if self._index is not None:
+            self._index.setdefault(norm_name, []).append(len(self._pairs))
+        self._pairs.append((norm_name, value))
+        existing = dict.get(self, norm_name)
+        dict.__setitem__(self, norm_name, value if existing is None else existing + ',' + value)
 
     def get_list(self, name):
-        """Returns all values for the given header as a list."""
-        norm_name = HTTPHeaders._normalize_name(name)
-        return self._as_list.get(norm_name, [])
+        """Returns all values for the given header as a list.
+
+        >>> h = HTTPHeaders()
+        >>> h.add("X-A", "1"); h.add("x-b", "2"); h.add("X-a", "3")
+        >>> h.get_list("x-a"), h.get_list("X-B"), h.get_list("X-C")
+        (['1', '3'], ['2'], [])
+        >>> h["X-A"] = "4"
+        >>> h.get_list("X-A"), h["x-a"]
+        (['4'], '4')
+        >>> del h["X-B"]
+        >>> h.get_list("X-B"), "X-B" in h, list(h.get_all())
+        ([], False, [('X-A', '4')])
+        """
+        positions = self._get_index().get(HTTPHeaders._normalize_name(name), ())
+        pairs = self._pairs
+        return [pairs[i][1] for i in positions]
 
     def get_all(self):
         """Returns an iterable of all (name, value) pairs.
 
         If a header has multiple values, multiple pairs will be
-        returned with the same name.
+        returned with the same name.  Pairs are returned in the order
+        they were added.
+
+        >>> h = HTTPHeaders.parse("B: 1\\r\\nA: 2\\r\\nB: 3\\r\\n")
+        >>> list(h.get_all())
+        [('B', '1'), ('A', '2'), ('B', '3')]
         """
-        for name, list in self._as_list.iteritems():
-            for value in list:
-                yield (name, value)
+        return iter(self._pairs)
 
     def parse_line(self, line):
         """Updates the dictionary with a single header line.
@@ -87,13 +114,19 @@ class HTTPHeaders(dict):
         >>> h.parse_line("Content-Type: text/html")
         >>> h.get('content-type')
         'text/html'
+        >>> h.parse_line("X-Long: a")
+        >>> h.parse_line("  b")
+        >>> h["X-Long"], h.get_list("X-Long")
+        ('a b', ['a b'])
         """
         if line[0].isspace():
             # continuation of a multi-line header
-            new_part = ' ' + line.lstrip()
-            self._as_list[self._last_key][-1] += new_part
-            dict.__setitem__(self, self._last_key,
-                             self[self._last_key] + new_part)
+            if not self._pairs:
+                raise HTTPInputError("first header line cannot start with whitespace")
+            self._unshare()
+            name, value = self._pairs[-1]
+            self._pairs[-1] = (name, value + ' ' + line.lstrip())
+            dict.__setitem__(self, name, ','.join(self.get_list(name)))
         else:
             name, value = line.split(":", 1)
             self.add(name, value.strip())
@@ -116,8 +149,18 @@ class HTTPHeaders(dict):
 
     def __setitem__(self, name, value):
         norm_name = HTTPHeaders._normalize_name(name)
+        self._unshare()
+        if not dict.__contains__(self, norm_name):
+            if self._index is not None:
+                self._index[norm_name] = [len(self._pairs)]
+            self._pairs.append((norm_name, value))
+        else:
+            # 替换第一个值的位置，保持header的顺序，其它的值全部删除
+            positions = self._get_index()[norm_name]
+            self._pairs[positions[0]] = (norm_name, value)
+            if len(positions) > 1:
+                self._remove(positions[1:])
         dict.__setitem__(self, norm_name, value)
-        self._as_list[norm_name] = [value]
 
     def __getitem__(self, name):
         return dict.__getitem__(self, HTTPHeaders._normalize_name(name))
@@ -125,7 +168,8 @@ class HTTPHeaders(dict):
     def __delitem__(self, name):
         norm_name = HTTPHeaders._normalize_name(name)
         dict.__delitem__(self, norm_name)
-        del self._as_list[norm_name]
+        self._unshare()
+        self._remove(self._get_index()[norm_name])
 
     def __contains__(self, name):
         norm_name = HTTPHeaders._normalize_name(name)
@@ -134,17 +178,79 @@ class HTTPHeaders(dict):
     def get(self, name, default=None):
         return dict.get(self, HTTPHeaders._normalize_name(name), default)
 
+    def setdefault(self, name, default=None):
+        if name not in self:
+            self[name] = default
+        return self[name]
+
+    _no_default = object()
+
+    def pop(self, name, default=_no_default):
+        if name not in self:
+            if default is HTTPHeaders._no_default:
+                raise KeyError(name)
+            return default
+        value = self[name]
+        del self[name]
+        return value
+
+    def clear(self):
+        dict.clear(self)
+        self._pairs = []
+        self._index = None
+        self._shared = False
+
     def update(self, *args, **kwargs):
         # dict.update bypasses our __setitem__
         for k, v in dict(*args, **kwargs).iteritems():
             self[k] = v
 
     def copy(self):
+        """Returns a copy that shares storage with this object until either is modified.
+
+        >>> h = HTTPHeaders({"A": "1"})
+        >>> c = h.copy()
+        >>> c.add("A", "2"); h["B"] = "3"
+        >>> sorted(h.get_all()), sorted(c.get_all())
+        ([('A', '1'), ('B', '3')], [('A', '1'), ('A', '2')])
+        >>> isinstance(c, dict), sorted(c.items())
+        (True, [('A', '1,2')])
+        """
         # default implementation returns dict(self), not the subclass
         return HTTPHeaders(self)
 
+    def __reduce__(self):
+        # 默认的实现在恢复实例属性之前就通过__setitem__放入dict的内容，并且每个名字只保留合并后的值
+        return _rebuild_headers, (self.__class__, list(self._pairs))
+
+    def _get_index(self):
+        index = self._index
+        if index is None:
+            index = {}
+            for i, (name, value) in enumerate(self._pairs):
+                positions = index.get(name)
+                if positions is None:
+                    index[name] = [i]
+                else:
+                    positions.append(i)
+            self._index = index
+        return index
+
+    def _unshare(self):
+        """ 修改之前调用：_pairs与其它对象共用时先复制一份。 """
+        if self._shared:
+            self._pairs = list(self._pairs)
+            self._index = None
+            self._shared = False
+
+    def _remove(self, positions):
+        removed = set(positions)
+        self._pairs = [pair for i, pair in enumerate(self._pairs) if i not in removed]
+        self._index = None
+
     _NORMALIZED_HEADER_RE = re.compile(r'^[A-Z0-9][a-z0-9]*(-[A-Z0-9][a-z0-9]*)*$')
     _normalized_headers = {}
+    _MAX_NORMALIZED_HEADERS = 1000 # 缓存的名字数量的上限，防止不断发送不同的header名耗尽内存
 
     @staticmethod
     def _normalize_name(name):
@@ -160,10 +266,115 @@ class HTTPHeaders(dict):
                 normalized = name
             else:
                 normalized = "-".join([w.capitalize() for w in name.split("-")])
-            HTTPHeaders._normalized_headers[name] = normalized
+            if len(HTTPHeaders._normalized_headers) < HTTPHeaders._MAX_NORMALIZED_HEADERS:
+                if type(normalized) is str:
+                    # intern之后各个请求中同样的名字共用一个字符串对象，作为dict的key时比较也更快
+                    normalized = intern(normalized)
+                HTTPHeaders._normalized_headers[name] = normalized
             return normalized
 
 
+def _rebuild_headers(cls, pairs):
+    """ 用于pickle和copy模块：按顺序重新加入所有的header。 """
+    headers = cls()
+    for name, value in pairs:
+        headers.add(name, value)
+    return headers
+
+
+class HTTPInputError(Exception):
+    """Exception raised by `parse_request_head` for a malformed request
+    head or one that exceeds the configured limits.
+    """
+    pass
+
+
+# 请求中常见的header名，原样和全部小写的形式都映射到同一个（intern过的）规范化名字，
+# 这样解析时大部分header名只需要一次dict查找，并且各个请求共用同一个字符串对象
+_COMMON_HEADER_NAMES = {}
+for _name in ("Accept", "Accept-Charset", "Accept-Encoding", "Accept-Language", "Authorization",
+              "Cache-Control", "Connection", "Content-Encoding", "Content-Length", "Content-Type",
+              "Cookie", "Dnt", "Expect", "Host", "If-Match", "If-Modified-Since", "If-None-Match",
+              "If-Range", "Keep-Alive", "Origin", "Pragma", "Range", "Referer", "Te", "Trailer",
+              "Transfer-Encoding", "Upgrade", "Upgrade-Insecure-Requests", "User-Agent", "Via",
+              "X-Forwarded-For", "X-Forwarded-Proto", "X-Real-Ip", "X-Requested-With", "X-Scheme",
+              "X-Xsrftoken", "X-Csrftoken"):
+    _name = intern(_name)
+    _COMMON_HEADER_NAMES[_name] = _COMMON_HEADER_NAMES[_name.lower()] = _name
+    HTTPHeaders._normalized_headers[_name] = _name
+del _name
+
+_NON_ASCII_RE = re.compile(r"[\x80-\xff]")
+
+
+def parse_request_head(data, max_headers=100, max_line_length=8192):
+    """Parses the start line and headers of an HTTP request.
+
+    ``data`` is the head as read from the connection, up to and including
+    the blank line that ends it.  Returns a tuple
+    ``(method, uri, version, headers)``, where ``headers`` is an
+    `HTTPHeaders`.  Raises `HTTPInputError` if the head is malformed, has
+    more than ``max_headers`` header lines, or contains a line longer
+    than ``max_line_length``.
+
+    >>> method, uri, version, h = parse_request_head(
+    ...     "GET /a?b=c HTTP/1.1\\r\\nHost: example.com\\r\\naccept: */*\\r\\n\\r\\n")
+    >>> method, uri, version
+    ('GET', '/a?b=c', 'HTTP/1.1')
+    >>> sorted(h.iteritems())
+    [('Accept', '*/*'), ('Host', 'example.com')]
+    """
+    if _NON_ASCII_RE.search(data):
+        # 与按latin1解码后再转换为native_str的结果保持一致
+        data = native_str(data.decode("latin1"))
+    lines = data.split("\n")
+    start_line = lines[0]
+    if start_line[-1:] == "\r":
+        start_line = start_line[:-1]
+    if len(start_line) > max_line_length:
+        raise HTTPInputError("HTTP request line too long")
+    try:
+        method, uri, version = start_line.split(" ")
+    except ValueError:
+        raise HTTPInputError("Malformed HTTP request line")
+    if not version.startswith("HTTP/"):
+        raise HTTPInputError("Malformed HTTP version in HTTP Request-Line")
+
+    # 直接填充HTTPHeaders内部的列表和dict，不再对每一行调用parse_line/add，按名字的位置索引在需要时才构建
+    headers = HTTPHeaders()
+    pairs = headers._pairs
+    common_names = _COMMON_HEADER_NAMES
+    dict_get = dict.get
+    dict_set = dict.__setitem__
+    for line in lines[1:]:
+        if line[-1:] == "\r":
+            line = line[:-1]
+        if not line:
+            continue
+        if len(line) > max_line_length:
+            raise HTTPInputError("HTTP header line too long")
+        if line[0] in " \t":
+            # 多行header的后续行
+            if not pairs:
+                raise HTTPInputError("Malformed HTTP header continuation line")
+            name, value = pairs[-1]
+            pairs[-1] = (name, value + " " + line.lstrip())
+            dict_set(headers, name, ",".join([v for n, v in pairs if n == name]))
+            continue
+        colon = line.find(":")
+        if colon < 0:
+            raise HTTPInputError("Malformed HTTP header line")
+        if len(pairs) == max_headers:
+            raise HTTPInputError("Too many HTTP headers")
+        name = line[:colon]
+        name = common_names.get(name) or HTTPHeaders._normalize_name(name)
+        value = line[colon + 1:].strip()
+        pairs.append((name, value))
+        existing = dict_get(headers, name)
+        dict_set(headers, name, value if existing is None else existing + "," + value)
+    return method, uri, version, headers
+
+
 def url_concat(url, args):
     """Concatenate url and argument dictionary regardless of whether
     url has existing query parameters.
@@ -186,8 +397,21 @@ class HTTPFile(ObjectDict):
     :ivar body:
     :ivar content_type: The content_type comes from the provided HTTP header
         and should not be trusted outright given that it can be easily forged.
+    :ivar file: For files spooled to disk by `MultipartParser`, a named
+        temporary file (positioned at the start) holding the contents;
+        otherwise ``None``.  Reading ``body`` on such a file reads the
+        whole temporary file into memory.
     """
-    pass
+    def __getattr__(self, name):
+        if name == "body" and "body" not in self and self.get("file") is not None:
+            # 内容在临时文件中，只在访问body时才读入内存
+            f = self["file"]
+            f.seek(0)
+            try:
+                return f.read()
+            finally:
+                f.seek(0)
+        return super(HTTPFile, self).__getattr__(name)
 
 
 def parse_body_arguments(content_type, body, arguments, files):
@@ -229,36 +453,274 @@ def parse_multipart_form_data(boundary, data, arguments, files):
     # in the wild.
     if boundary.startswith(b('"')) and boundary.endswith(b('"')):
         boundary = boundary[1:-1]
-    final_boundary_index = data.rfind(b("--") + boundary + b("--"))
-    if final_boundary_index == -1:
+    if data.rfind(b("--") + boundary + b("--")) == -1:
         logging.warning("Invalid multipart/form-data: no final boundary")
         return
-    parts = data[:final_boundary_index].split(b("--") + boundary + b("\r\n"))
-    for part in parts:
-        if not part:
-            continue
-        eoh = part.find(b("\r\n\r\n"))
-        if eoh == -1:
-            logging.warning("multipart/form-data missing headers")
-            continue
-        headers = HTTPHeaders.parse(part[:eoh].decode("utf-8"))
+    # 整个请求体已经在内存中了，写到临时文件里没有意义
+    parser = MultipartParser(boundary, arguments, files, spool_threshold=None)
+    parser.feed(data)
+    parser.close()
+
+
+class MultipartParser(object):
+    """An incremental multipart/form-data parser.
+
+    Feed it the body in chunks of any size with `feed` and call `close`
+    at the end.  Each part is added to ``arguments`` or ``files`` as soon
+    as it is complete, and ``part_callback(name, value)`` (if given) is
+    called with the field value or `HTTPFile`.  The contents of a file
+    part are kept in memory until they exceed ``spool_threshold`` bytes,
+    then written to a temporary file in ``spool_dir`` (see
+    `HTTPFile`.file); ``None`` never spools.  Memory use is bounded by the
+    chunk size, the threshold and the size of the non-file fields.
+    Malformed input is logged and parsing stops, like
+    `parse_multipart_form_data`.
+
+    Typical use in a `tornado.web.stream_request_body` handler::
+
+        def prepare(self):
+            self.parser = MultipartParser.from_content_type(
+                self.request.headers.get("Content-Type", ""),
+                self.request.arguments, self.request.files)
+
+        def data_received(self, chunk):
+            self.parser.feed(chunk)
+
+        def post(self):
+            self.parser.close()
+    """
+    MAX_HEADERS_SIZE = 64 * 1024
+
+    # 解析的状态
+    _PREAMBLE, _BOUNDARY, _HEADERS, _BODY, _DONE = range(5)
+
+    def __init__(self, boundary, arguments, files, spool_threshold=1024 * 1024,
+                 spool_dir=None, part_callback=None):
+        if boundary.startswith(b('"')) and boundary.endswith(b('"')):
+            boundary = boundary[1:-1]
+        self.arguments = arguments
+        self.files = files
+        self.spool_threshold = spool_threshold
+        self.spool_dir = spool_dir
+        self.part_callback = part_callback
+        # 分隔符前面的CRLF属于分隔符。在数据前面补上一个CRLF，第一个分隔符就和其他的一样了
+        self._delimiter = b("\r\n--") + boundary
+        self._buffer = bytearray(b("\r\n"))
+        self._state = self._PREAMBLE
+        self._part = None # 当前的part：(name, HTTPFile或None, 内存中的数据块)，无效的part为None
+        self._part_size = 0 # 当前的part在内存中的字节数
+
+    @classmethod
+    def from_content_type(cls, content_type, arguments, files, **kwargs):
+        """Returns a parser for a request with the given Content-Type header,
+        or ``None`` if it is not multipart/form-data with a boundary."""
+        if not content_type.startswith("multipart/form-data"):
+            return None
+        for field in content_type.split(";"):
+            k, sep, v = field.strip().partition("=")
+            if k == "boundary" and v:
+                return cls(utf8(v), arguments, files, **kwargs)
+        return None
+
+    def feed(self, data):
+        """Parses the next chunk of the body."""
+        if self._state == self._DONE:
+            return
+        buf = self._buffer
+        buf += data
+        pos = 0
+        while self._state != self._DONE:
+            if self._state == self._PREAMBLE:
+                # 与原来用split实现时一样，不以分隔符开头时把第一个分隔符之前的内容也当作一个part
+                first = self._delimiter[2:]
+                if len(buf) < 2 + len(first):
+                    break
+                if buf.startswith(first, 2):
+                    self._state = self._BODY # 之后马上会找到（补上的CRLF开头的）第一个分隔符
+                else:
+                    pos = 2
+                    self._state = self._HEADERS
+            elif self._state == self._BOUNDARY:
+                # 分隔符之后是"--"（结束）或者可能带有空白的CRLF
+                end = buf.find(b("\r\n"), pos)
+                if buf[pos:pos + 2] == b("--"):
+                    self._state = self._DONE
+                elif end == -1:
+                    break
+                elif buf[pos:end].strip():
+                    self._fail("Invalid multipart/form-data: bad boundary line")
+                else:
+                    pos = end + 2
+                    self._state = self._HEADERS
+            elif self._state == self._HEADERS:
+                if buf[pos:pos + 2] == b("\r\n"): # 没有header的part
+                    eoh, eoh_length = pos, 2
+                else:
+                    eoh, eoh_length = buf.find(b("\r\n\r\n"), pos), 4
+                end = buf.find(self._delimiter, pos)
+                if end != -1 and (eoh == -1 or end < eoh):
+                    logging.warning("multipart/form-data missing headers")
+                    pos = end + len(self._delimiter)
+                    self._state = self._BOUNDARY
+                    continue
+                if eoh == -1:
+                    if len(buf) - pos > self.MAX_HEADERS_SIZE:
+                        self._fail("multipart/form-data part headers too long")
+                    break
+                self._start_part(bytes(buf[pos:eoh]))
+                pos = eoh + eoh_length
+                self._state = self._BODY
+            else:
+                end = buf.find(self._delimiter, pos)
+                if end == -1:
+                    # 末尾可能是分隔符的一部分，留到下一次
+                    end = max(pos, len(buf) - len(self._delimiter) + 1)
+                    self._part_data(buf, pos, end)
+                    pos = end
+                    break
+                self._part_data(buf, pos, end)
+                self._finish_part()
+                pos = end + len(self._delimiter)
+                self._state = self._BOUNDARY
+        if self._state == self._DONE:
+            del buf[:]
+        else:
+            del buf[:pos]
+
+    def close(self):
+        """Finishes parsing; logs a warning if the final boundary is missing."""
+        if self._state != self._DONE:
+            self._fail("Invalid multipart/form-data: no final boundary")
+
+    def _fail(self, message):
+        logging.warning(message)
+        self._state = self._DONE
+        self._part = None
+
+    def _start_part(self, header_data):
+        self._part = None
+        try:
+            headers = HTTPHeaders.parse(header_data.decode("utf-8"))
+        except ValueError:
+            logging.warning("Invalid multipart/form-data part headers")
+            return
         disp_header = headers.get("Content-Disposition", "")
         disposition, disp_params = _parse_header(disp_header)
-        if disposition != "form-data" or not part.endswith(b("\r\n")):
+        if disposition != "form-data":
             logging.warning("Invalid multipart/form-data")
-            continue
-        value = part[eoh + 4:-2]
+            return
         if not disp_params.get("name"):
             logging.warning("multipart/form-data value missing name")
-            continue
-        name = disp_params["name"]
+            return
         if disp_params.get("filename"):
             ctype = headers.get("Content-Type", "application/unknown")
-            files.setdefault(name, []).append(HTTPFile(
-                filename=disp_params["filename"], body=value,
-                content_type=ctype))
+            http_file = HTTPFile(filename=disp_params["filename"], content_type=ctype, file=None)
+        else:
+            http_file = None
+        self._part = (disp_params["name"], http_file, [])
+        self._part_size = 0
+
+    def _part_data(self, buf, start, end):
+        if self._part is None or start == end:
+            return
+        name, http_file, chunks = self._part
+        if http_file is not None and http_file.file is not None:
+            http_file.file.write(memoryview(buf)[start:end])
+            return
+        chunks.append(memoryview(buf)[start:end].tobytes())
+        self._part_size += end - start
+        if (http_file is not None and self.spool_threshold is not None and
+            self._part_size > self.spool_threshold):
+            http_file.file = tempfile.NamedTemporaryFile(prefix="tornado-upload-", dir=self.spool_dir)
+            for c in chunks:
+                http_file.file.write(c)
+            del chunks[:]
+
+    def _finish_part(self):
+        if self._part is None:
+            return
+        name, http_file, chunks = self._part
+        self._part = None
+        if http_file is None:
+            value = b("").join(chunks)
+            self.arguments.setdefault(name, []).append(value)
+        else:
+            if http_file.file is not None:
+                http_file.file.flush()
+                http_file.file.seek(0)
+            else:
+                http_file.body = b("").join(chunks)
+            value = http_file
+            self.files.setdefault(name, []).append(http_file)
+        if self.part_callback is not None:
+            self.part_callback(name, value)
+
+
+_RANGE_SPEC_RE = re.compile(r"^(\d*)-(\d*)$")
+
+
+def parse_range_header(value, size):
+    """Parses a Range header for a resource of ``size`` bytes.
+
+    Returns a list of ``(start, end)`` pairs (``end`` exclusive), sorted
+    and with overlapping or adjacent ranges merged.  Returns None if the
+    header is malformed (it should then be ignored) and an empty list if
+    none of the ranges can be satisfied (416).
+
+    >>> parse_range_header("bytes=0-499", 1000)
+    [(0, 500)]
+    >>> parse_range_header("bytes=500-", 1000)
+    [(500, 1000)]
+    >>> parse_range_header("bytes=-200", 1000)
+    [(800, 1000)]
+    >>> parse_range_header("bytes=0-9, 20-29, 10-12", 1000)
+    [(0, 13), (20, 30)]
+    >>> parse_range_header("bytes=900-1999", 1000)
+    [(900, 1000)]
+    >>> parse_range_header("bytes=1000-", 1000)
+    []
+    >>> parse_range_header("bytes=5-1", 1000) is None
+    True
+    >>> parse_range_header("items=0-1", 1000) is None
+    True
+    """
+    unit, sep, spec = value.partition("=")
+    if not sep or unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        match = _RANGE_SPEC_RE.match(part)
+        if match is None:
+            return None
+        start, end = match.groups()
+        if not start:
+            if not end:
+                return None
+            # "-n"表示最后n个字节
+            length = int(end)
+            if length:
+                ranges.append((max(0, size - length), size))
+            continue
+        start = int(start)
+        if end:
+            end = int(end) + 1
+            if end <= start:
+                return None
+        else:
+            end = size
+        if start < size:
+            ranges.append((start, min(end, size)))
+    ranges.sort()
+    merged = []
+    for start, end in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
         else:
-            arguments.setdefault(name, []).append(value)
+            merged.append((start, end))
+    return merged
 
 
 # _parseparam and _parse_header are copied and modified from python2.7's cgi.py
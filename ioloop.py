@@ -4,16 +4,20 @@ from __future__ import absolute_import, division, with_statement
 
 import datetime
 import errno
+import functools
 import heapq
 import os
 import logging
+import math
 import select
+import struct
 import thread
 import threading
 import time
 import traceback
 
 from tornado import stack_context
+from tornado.util import raise_exc_info
 
 try:
     import signal
@@ -35,35 +39,43 @@ class IOLoop(object):
     _EPOLLHUP = 0x010         # 异常挂断事件(epoll总是关注此事件)
     _EPOLLRDHUP = 0x2000      # 对端挂断事件(未用到)
     _EPOLLONESHOT = (1 << 30) # 设置one-shot模式(未用到)
-    _EPOLLET = (1 << 31)      # 设置边缘触发模式(未用到)
+    _EPOLLET = (1 << 31)      # 设置边缘触发模式(IOLoop.EDGE)
 
     ## IOLoop的事件映射
     NONE = 0
     READ = _EPOLLIN
     WRITE = _EPOLLOUT
     ERROR = _EPOLLERR | _EPOLLHUP
+    EDGE = _EPOLLET           # 与事件一起注册，表示以边缘触发模式监听该fd（只有epoll支持）
 
     ## 保证ioloop的全局唯一单例
     _instance_lock = threading.Lock()
 
-    def __init__(self, impl=None):
+    def __init__(self, impl=None, timer=None, edge_triggered=False):
         self._impl = impl or _poll()           # Linux下即epoll
         if hasattr(self._impl, 'fileno'):      # 若支持，设置FD_CLOEXEC
             set_close_exec(self._impl.fileno())
 
+        # 边缘触发模式：IOStream只向epoll注册一次READ|WRITE|EDGE，之后自己记录fd的就绪状态，不再调用update_handler
+        if edge_triggered and not (isinstance(self._impl, _EPoll) or
+                                   (hasattr(select, "epoll") and isinstance(self._impl, select.epoll))):
+            raise ValueError("edge_triggered requires an epoll-based IOLoop")
+        self.edge_triggered = edge_triggered
+
         self._callback_lock = threading.Lock() # 使self._callbacks可用于多线程
 
         self._handlers = {}      # epoll中每个fd的处理函数Map
         self._events = {}        # epoll返回的待处理事件Map
         self._callbacks = []     # 用户加入的回调函数列表
-        self._timeouts = []      # ioloop中基于时间的调度，是一个小根堆
+        self._timeouts = timer if timer is not None else _HeapTimer() # ioloop中基于时间的调度，默认是一个小根堆，也可以传入TimingWheel
 
         self._running = False      # 标记ioloop已经调用了start，还未调用stop
         self._stopped = False      # 标记ioloop循环已退出，或已调用了stop
         self._thread_ident = None  # 标记ioloop所运行的线程，以支持多线程访问
         self._blocking_signal_threshold = None
+        self._executor = None      # run_in_executor默认使用的线程池，第一次用到时才创建
 
-        self._waker = Waker()    # 创建一个管道，用于在其他线程调用add_callback时唤醒epoll_wait
+        self._waker = _make_waker() # 创建一个eventfd（或管道），用于在其他线程调用add_callback时唤醒epoll_wait
         self.add_handler(self._waker.fileno(), lambda fd, events: self._waker.consume(), self.READ)
 
     @staticmethod
@@ -94,6 +106,8 @@ class IOLoop(object):
                     os.close(fd)
                 except Exception:
                     logging.debug("error closing fd %s", fd, exc_info=True)
+        if self._executor is not None: # 关闭默认的线程池，不等待正在运行的任务
+            self._executor.shutdown(wait=False)
         self._waker.close()    # 释放_waker管道
         self._impl.close()     # 释放epoll实例
 
@@ -150,20 +164,16 @@ class IOLoop(object):
             for callback in callbacks:
                 self._run_callback(callback)
 
-            ## 基于时间的调度：不断从self._timeouts这个小根堆中取出deadline最早的timeout任务，
-            ## 若deadline已到，则马上调用其callback；否则，重新调整poll_timeout以确保下次loop时能调用该timeout。
+            ## 基于时间的调度：从定时器中取出所有deadline已到的timeout任务，马上调用其callback；
+            ## 然后根据最近的一个deadline重新调整poll_timeout以确保下次loop时能调用该timeout。
             if self._timeouts:
                 now = time.time()
-                while self._timeouts:
-                    if self._timeouts[0].callback is None:
-                        heapq.heappop(self._timeouts)
-                    elif self._timeouts[0].deadline <= now:
-                        timeout = heapq.heappop(self._timeouts)
+                for timeout in self._timeouts.pop_expired(now):
+                    if timeout.callback is not None: # 可能已经被之前运行的callback取消了
                         self._run_callback(timeout.callback)
-                    else:
-                        seconds = self._timeouts[0].deadline - now
-                        poll_timeout = min(seconds, poll_timeout)
-                        break
+                deadline = self._timeouts.next_deadline()
+                if deadline is not None:
+                    poll_timeout = min(max(0.0, deadline - now), poll_timeout)
 
             ## 如果在处理callbacks和timeouts的时候又加入了新的callback，则epoll_wait不等待，以免阻塞了callbacks
             if self._callbacks:
@@ -231,22 +241,63 @@ class IOLoop(object):
         """ 在IOLoop中，当deadline到点时调用callback。返回一个可用于取消的句柄。
         在其他线程调用该方法不安全，应该在IOLoop线程中添加（利用add_callback方法）。 """
         timeout = _Timeout(deadline, stack_context.wrap(callback))
-        heapq.heappush(self._timeouts, timeout)
+        self._timeouts.add(timeout)
         return timeout
 
     def remove_timeout(self, timeout):
         """ 取消一个pending的timeout。 """
-        timeout.callback = None # _timeouts是个堆，这里只简单地把callback设置为None，具体的移除还是在IOLoop中
+        self._timeouts.remove(timeout)
 
     def add_callback(self, callback):
         """ 在下一轮IOLoop中调用给定的callback。
         这是唯一一个在任何时间、任何线程都能安全调用的方法。其他的操作都应该使用该方法加入到IOLoop中。 """
+        callback = stack_context.wrap(callback) # 在锁外面包装，缩短持有锁的时间
         with self._callback_lock:
             list_empty = not self._callbacks
-            self._callbacks.append(stack_context.wrap(callback))
+            self._callbacks.append(callback)
         if list_empty and thread.get_ident() != self._thread_ident:
             self._waker.wake() # 如果是在非IOLoop线程中加入callback到了一个空_callbacks集合中，则试图唤醒IOLoop
 
+    def add_callbacks(self, callbacks):
+        """ 在下一轮IOLoop中依次调用给定的多个callback。
+        与对每一个callback调用add_callback等价，但只加一次锁，并且最多唤醒一次IOLoop。
+        和add_callback一样，可以在任何线程中安全调用，适合工作线程批量地把结果交回IOLoop。 """
+        callbacks = [stack_context.wrap(callback) for callback in callbacks]
+        if not callbacks:
+            return
+        with self._callback_lock:
+            list_empty = not self._callbacks
+            self._callbacks.extend(callbacks)
+        if list_empty and thread.get_ident() != self._thread_ident:
+            self._waker.wake()
+
+    def run_in_executor(self, executor, fn, *args, **kwargs):
+        """ 在executor（tornado.executor中的线程池或进程池）中调用fn(*args, **kwargs)，以免阻塞IOLoop。
+        关键字参数callback会在IOLoop线程中以fn的返回值为参数被调用；fn抛出的异常也会在IOLoop线程中，
+        在调用本方法时的StackContext里重新抛出。所以它可以直接和gen.Task一起使用：
+
+            result = yield gen.Task(io_loop.run_in_executor, pool, hash_password, password)
+
+        executor为None时使用该IOLoop默认的线程池。池中未完成的任务太多时，本方法直接抛出ExecutorQueueFull。 """
+        if executor is None:
+            executor = self._default_executor()
+        callback = stack_context.wrap(kwargs.pop("callback", None))
+        reraise = stack_context.wrap(raise_exc_info) # 捕获当前的StackContext，异常会交给其中的ExceptionStackContext处理
+
+        def done(result, exc_info): # 在工作线程中被调用，通过add_callback把结果交回IOLoop线程
+            if exc_info is not None:
+                self.add_callback(functools.partial(reraise, exc_info))
+            elif callback is not None:
+                self.add_callback(functools.partial(callback, result))
+        executor.submit(fn, args, kwargs, done)
+
+    def _default_executor(self):
+        if self._executor is None:
+            # import is here rather than top level because executor.py imports multiprocessing
+            from tornado.executor import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor()
+        return self._executor
+
     def _run_callback(self, callback):
         try:
             callback() # 直接调用callback
@@ -263,7 +314,7 @@ class _Timeout(object):
     """An IOLoop timeout, a UNIX timestamp and a callback"""
 
     # Reduce memory overhead when there are lots of pending callbacks
-    __slots__ = ['deadline', 'callback']
+    __slots__ = ['deadline', 'callback', 'tick', 'slot']
 
     def __init__(self, deadline, callback):
         if isinstance(deadline, (int, long, float)):
@@ -273,6 +324,8 @@ class _Timeout(object):
         else:
             raise TypeError("Unsupported deadline %r" % deadline)
         self.callback = callback
+        self.tick = None # 以下两个字段只由TimingWheel使用：到期的tick编号，以及所在的槽
+        self.slot = None
 
     @staticmethod
     def timedelta_to_seconds(td):
@@ -292,6 +345,217 @@ class _Timeout(object):
                 (other.deadline, id(other)))
 
 
+class _EventFDWaker(object):
+    """ 基于Linux eventfd的Waker，与管道实现的Waker接口相同。
+    只占用一个fd，wake是对一个计数器的8字节写，consume一次read就能把计数器清零（而管道要一直读到空）。 """
+    _ONE = struct.pack("=Q", 1)
+
+    def __init__(self):
+        self._fd = _eventfd(0, _EFD_CLOEXEC | _EFD_NONBLOCK)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self._fd
+
+    def wake(self):
+        try:
+            os.write(self._fd, self._ONE)
+        except OSError: # 计数器溢出(EAGAIN)时IOLoop必然已经被唤醒了
+            pass
+
+    def consume(self):
+        try:
+            os.read(self._fd, 8)
+        except OSError:
+            pass
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _make_waker():
+    """ 优先使用eventfd，不支持时（非Linux，或者内核/libc太老）回到基于管道的Waker上。 """
+    if _eventfd is not None:
+        try:
+            return _EventFDWaker()
+        except OSError:
+            pass
+    return Waker()
+
+
+class _HeapTimer(object):
+    """ 默认的定时器：一个按deadline排序的小根堆。
+    插入为O(log n)；取消时只是把callback设置为None，被取消的timeout要等到了堆顶才会真正被移除。 """
+
+    def __init__(self):
+        self._heap = []
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, timeout):
+        heapq.heappush(self._heap, timeout)
+
+    def remove(self, timeout):
+        timeout.callback = None # 这里只简单地把callback设置为None，具体的移除还是在pop_expired和next_deadline中
+
+    def pop_expired(self, now):
+        """ 弹出并返回所有deadline已到的timeout，按deadline排序。 """
+        heap = self._heap
+        expired = []
+        while heap:
+            if heap[0].callback is None:
+                heapq.heappop(heap)
+            elif heap[0].deadline <= now:
+                expired.append(heapq.heappop(heap))
+            else:
+                break
+        return expired
+
+    def next_deadline(self):
+        """ 返回最近的一个deadline，若没有pending的timeout则返回None。 """
+        heap = self._heap
+        while heap and heap[0].callback is None:
+            heapq.heappop(heap)
+        if heap:
+            return heap[0].deadline
+        return None
+
+
+class _WheelSlot(set):
+    """ 时间轮中的一个槽，记住自己所在的层，以便取消timeout时更新该层的计数。 """
+    __slots__ = ['level']
+
+    def __init__(self, level):
+        set.__init__(self)
+        self.level = level
+
+
+class TimingWheel(object):
+    """ 分层时间轮实现的定时器。通过IOLoop(timer=TimingWheel())来选用，适合有大量pending timeout的IOLoop。
+
+    时间被划分为长度为tick_seconds的tick，共levels层，每层wheel_size个槽。默认为4层×256槽、10ms一个tick，
+    可覆盖约497天，更远的timeout先放在最高层，转到时再重新分配。
+    插入和取消都是O(1)，取消的timeout会马上从所在的槽中移除。第0层每转完一圈，
+    就把上一层对应槽里的timeout重新分配到下面的层中（cascade）。
+    timeout在其deadline向上取整所在的tick才会触发，所以不会提前，最多延迟一个tick。 """
+
+    def __init__(self, tick_seconds=0.01, wheel_size=256, levels=4):
+        assert wheel_size > 1 and wheel_size & (wheel_size - 1) == 0, "wheel_size must be a power of 2"
+        self.tick_seconds = tick_seconds
+        self._bits = wheel_size.bit_length() - 1 # 每一层占用tick编号中的位数
+        self._mask = wheel_size - 1
+        self._levels = levels
+        self._wheels = [[_WheelSlot(level) for i in xrange(wheel_size)] for level in xrange(levels)]
+        self._counts = [0] * levels # 每一层中timeout的数量，用于跳过空的层
+        self._size = 0
+        self._current = int(time.time() / tick_seconds) # 下一个要处理的tick编号，更早的tick都已经处理过了
+
+    def __len__(self):
+        return self._size
+
+    def add(self, timeout):
+        timeout.tick = int(math.ceil(timeout.deadline / self.tick_seconds))
+        self._place(timeout)
+
+    def remove(self, timeout):
+        timeout.callback = None
+        slot = timeout.slot
+        if slot is not None: # 已经触发过的timeout不在任何槽中
+            slot.discard(timeout)
+            timeout.slot = None
+            self._counts[slot.level] -= 1
+            self._size -= 1
+
+    def pop_expired(self, now):
+        """ 把时间轮转到now，弹出并返回所有到期的timeout，按deadline排序。 """
+        target = int(now / self.tick_seconds)
+        expired = []
+        while self._current <= target:
+            if not self._counts[0]:
+                # 第0层是空的，中间的tick都不用处理，直接跳到下一次需要cascade的tick
+                next_tick = self._next_cascade_tick()
+                if next_tick is None or next_tick > target:
+                    self._current = target + 1
+                    break
+                self._current = next_tick
+            self._cascade()
+            slot = self._wheels[0][self._current & self._mask]
+            if slot:
+                self._counts[0] -= len(slot)
+                self._size -= len(slot)
+                for timeout in slot:
+                    timeout.slot = None
+                expired.extend(slot)
+                slot.clear()
+            self._current += 1
+        expired.sort()
+        return expired
+
+    def next_deadline(self):
+        """ 返回第0层最近一个非空的槽到期的时刻和下一次cascade的时刻中较早的一个。若没有pending的timeout则返回None。
+        上面的层中的timeout可能比第0层的更早到期，所以必须在cascade的时刻醒来，把它们分配到第0层：
+
+        >>> w = TimingWheel(tick_seconds=1, wheel_size=4, levels=3)
+        >>> w._current = 0
+        >>> w.add(_Timeout(5, None))  # 距离5个tick，放在第1层
+        >>> w._current = 3            # tick 0~2已经处理过
+        >>> w.add(_Timeout(6, None))  # 距离3个tick，放在第0层
+        >>> w.next_deadline()         # tick 4时cascade，之后tick 5的timeout才能按时触发
+        4
+        """
+        if not self._size:
+            return None
+        tick = self._next_cascade_tick()
+        if self._counts[0]:
+            wheel = self._wheels[0]
+            for i in xrange(self._mask + 1):
+                if wheel[(self._current + i) & self._mask]:
+                    if tick is None or self._current + i < tick:
+                        tick = self._current + i
+                    break
+        return tick * self.tick_seconds
+
+    def _place(self, timeout):
+        """ 根据timeout到期的tick距当前tick的远近，把它放到对应层的槽中。 """
+        tick = max(timeout.tick, self._current) # 已经过期的timeout放到当前的槽中，马上就会触发
+        delta = tick - self._current
+        level = 0
+        while level < self._levels - 1 and delta >> (self._bits * (level + 1)):
+            level += 1
+        if delta >> (self._bits * self._levels): # 超出了时间轮的范围，先放在最高层最远的槽里
+            tick = self._current + (1 << (self._bits * self._levels)) - 1
+        slot = self._wheels[level][(tick >> (self._bits * level)) & self._mask]
+        slot.add(timeout)
+        timeout.slot = slot
+        self._counts[level] += 1
+        self._size += 1
+
+    def _cascade(self):
+        """ 当前tick是第level层的一圈的起点时，把第level层对应的槽中的timeout重新分配到下面的层中。 """
+        level = 1
+        while level < self._levels and not self._current & ((1 << (self._bits * level)) - 1):
+            slot = self._wheels[level][(self._current >> (self._bits * level)) & self._mask]
+            if slot:
+                timeouts = list(slot)
+                slot.clear()
+                self._counts[level] -= len(timeouts)
+                self._size -= len(timeouts)
+                for timeout in timeouts:
+                    self._place(timeout)
+            level += 1
+
+    def _next_cascade_tick(self):
+        """ 返回最低的非空层（第0层之上）下一次cascade的tick编号，若上面的层都为空则返回None。 """
+        for level in xrange(1, self._levels):
+            if self._counts[level]:
+                span = 1 << (self._bits * level)
+                return (self._current + span - 1) & ~(span - 1) # 向上对齐到span的整数倍
+        return None
+
+
 class PeriodicCallback(object):
     """Schedules the given callback to be called periodically.
 
@@ -475,6 +739,17 @@ class _Select(object):
         return events.items()
 
 
+# eventfd(2)没有对应的python接口，通过ctypes从libc中取出来。
+_EFD_CLOEXEC = 0x80000 # O_CLOEXEC
+_EFD_NONBLOCK = 0x800   # O_NONBLOCK
+try:
+    import ctypes
+    import ctypes.util
+    _eventfd = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True).eventfd
+    _eventfd.argtypes = [ctypes.c_uint, ctypes.c_int]
+except Exception: # 没有ctypes，或者libc中没有eventfd
+    _eventfd = None
+
 # 选择poll的实现。优先使用epoll/kqueu，如果没有则回到select上。
 if hasattr(select, "epoll"):
     _poll = select.epoll # Python 2.6+ on Linux
@@ -4,6 +4,7 @@ from __future__ import absolute_import, division, with_statement
 
 import collections
 import errno
+import itertools
 import logging
 import os
 import socket
@@ -35,16 +36,22 @@ class IOStream(object):
         self.max_buffer_size = max_buffer_size             # buffer最大大小
         self.read_chunk_size = read_chunk_size             # 一次读取的大小
 
-        self._read_buffer = collections.deque()            # 读buffer
+        self._read_buffer = bytearray()                    # 读buffer，有效的数据是_read_buffer[_read_buffer_pos:]
+        self._read_buffer_pos = 0                          # 读buffer中已经消费掉的字节数，消费的多了才真正从头部删除
         self._write_buffer = collections.deque()           # 写buffer（不为空则表示当前iostream正在写）
         self._read_buffer_size = 0                         # 读buffer当前大小
+        self._write_buffer_pos = 0                         # _write_buffer[0]中已经发送出去的字节数（只用于分散写）
         self._write_buffer_frozen = False
+        self._vectored_write = _send_vectored is not None  # 用一次系统调用发送_write_buffer中的多个chunk，不必先合并
+        self._use_sendfile = _sendfile is not None         # write_file时用sendfile直接从文件发送到socket
 
         ## iostream有如下4种读取状态：
         self._read_delimiter = None     # 若该变量非None，则读取直到某一分隔符，同时该变量就是要求读到的分隔符
         self._read_regex = None         # 若该变量非None，则读取直到某一正则，同时该变量就是要求读到的正则
+        self._read_max_bytes = None     # read_until的max_bytes参数
         self._read_bytes = None         # 若该变量非None，则读取固定的字符数，同时该变量就是要求读到的字符数
         self._read_until_close = False  # 若该变量为True，则读取直到关闭
+        self._read_as_view = False      # read_bytes和read_until_close的as_view参数
 
         ## iostream有如下的回调：
         ## 所有这些callback在设置时都使用stack_context.wrap包装，并加入到ioloop中调用，
@@ -54,12 +61,19 @@ class IOStream(object):
         self._write_callback = None     # 写回调
         self._close_callback = None     # 关闭回调
         self._connect_callback = None   # 连接成功回调
+        self._socket_close_callback = None # socket关闭时立即同步调用（不经过IOLoop），TCPServer用它统计打开的连接数
 
         ## iostream有如下一些辅助状态：
         self._connecting = False    # 连接标志（不为False则表示当前iostream正在连接）
         self._state = None          # (IOLoop.NONE, IOLoop.READ, IOLoop.WRITE, IOLoop.ERROR)，与io_loop的注册保持一致.
         self._pending_callbacks = 0 # 未决的回调数量
 
+        ## 边缘触发模式下，fd只在变为就绪时通知一次，iostream要自己记住就绪状态：
+        self._edge_triggered = self.io_loop.edge_triggered
+        self._readable = False      # 收到过可读通知，且之后还没有读到EAGAIN
+        self._read_paused = False   # 见pause_reading
+        self._writable = True       # 上一次写没有遇到EAGAIN（即写缓冲区可能还有空间）
+
     def connect(self, address, callback=None):
         """ 发起连接 """
         self._connecting = True # 收到可写通知时检查此标志
@@ -79,30 +93,38 @@ class IOStream(object):
         self._read_regex = re.compile(regex) # 设置要读取的正则
         self._try_inline_read()
 
-    def read_until(self, delimiter, callback):
-        """ 读取直到某一分隔符。 """
+    def read_until(self, delimiter, callback, max_bytes=None):
+        """ 读取直到某一分隔符。
+        max_bytes不为None时，读到的数据（包括分隔符）超过max_bytes字节仍然没有完成读操作就关闭连接，
+        callback不会被调用，读buffer中最多只保留max_bytes字节左右的数据。 """
         self._set_read_callback(callback)    # 设置读回调
         self._read_delimiter = delimiter     # 设置要读取的定界符
+        self._read_max_bytes = max_bytes
         self._try_inline_read()
 
-    def read_bytes(self, num_bytes, callback, streaming_callback=None):
+    def read_bytes(self, num_bytes, callback, streaming_callback=None, as_view=False):
         """ 读取固定的字符数。
-        如果streaming_callback不为空，则它将处理所有的数据，callback得到的参数将为空。 """
+        如果streaming_callback不为空，则它将处理所有的数据，callback得到的参数将为空。
+        as_view为True时callback和streaming_callback得到的是读buffer的memoryview而不是新的字符串，省去一次复制；
+        memoryview之后不会被iostream修改，需要字符串时调用它的tobytes()。 """
         self._set_read_callback(callback)    # 设置读回调
         assert isinstance(num_bytes, (int, long))
         self._read_bytes = num_bytes         # 设置要读取的字符数
+        self._read_as_view = as_view
         self._streaming_callback = stack_context.wrap(streaming_callback)
         self._try_inline_read()
 
-    def read_until_close(self, callback, streaming_callback=None):
+    def read_until_close(self, callback, streaming_callback=None, as_view=False):
         """ 读取直到关闭。
-        如果streaming_callback不为空，则它将处理所有的数据，callback得到的参数将为空。 """
+        如果streaming_callback不为空，则它将处理所有的数据，callback得到的参数将为空。
+        as_view的含义与read_bytes相同。 """
         self._set_read_callback(callback)
         self._streaming_callback = stack_context.wrap(streaming_callback)
+        self._read_as_view = as_view
         if self.closed(): # 如果已经关闭则一次性消费完整个_read_buffer然后返回
             if self._streaming_callback is not None:
-                self._run_callback(self._streaming_callback, self._consume(self._read_buffer_size))
-            self._run_callback(self._read_callback, self._consume(self._read_buffer_size))
+                self._run_callback(self._streaming_callback, self._consume(self._read_buffer_size, as_view))
+            self._run_callback(self._read_callback, self._consume(self._read_buffer_size, as_view))
             self._streaming_callback = None
             self._read_callback = None
             return
@@ -117,17 +139,32 @@ class IOStream(object):
         # 不要把''放进来，会被当成无数据
         if data:
             WRITE_BUFFER_CHUNK_SIZE = 128 * 1024
-            # 把超过大小的字符串打散后再追加到_write_buffer中
-            if len(data) > WRITE_BUFFER_CHUNK_SIZE:
+            # 把超过大小的字符串打散后再追加到_write_buffer中（分散写不需要合并chunk，也就不用打散）
+            if len(data) > WRITE_BUFFER_CHUNK_SIZE and not self._vectored_write:
                 for i in range(0, len(data), WRITE_BUFFER_CHUNK_SIZE):
                     self._write_buffer.append(data[i:i + WRITE_BUFFER_CHUNK_SIZE])
             else:
                 self._write_buffer.append(data)
+        self._start_write(callback)
+
+    def write_file(self, fileobj, offset, count, callback=None):
+        """ 把文件fileobj中从offset开始的count个字节写到流中，排在之前write的数据之后。callback的含义与write相同。
+        普通的socket上使用sendfile，数据不经过python；不能用sendfile时（如SSL连接）每次读一块再发送，不会把整个文件读到内存中。
+        iostream不会关闭fileobj，调用者要在callback中（或者连接关闭之后）关闭它。 """
+        self._check_closed()
+        if count:
+            self._write_buffer.append(_FileSegment(fileobj, offset, count))
+        self._start_write(callback)
+
+    def _start_write(self, callback):
         self._write_callback = stack_context.wrap(callback)
         if not self._connecting: # 如果是正在连接中就先别写
-            self._handle_write()
+            if self._writable:   # 边缘触发模式下已知不可写时，不用尝试，等可写通知
+                self._handle_write()
             if self._write_buffer: # 没有写完，注册个可写通知下次再写
                 self._add_io_state(self.io_loop.WRITE)
+            elif self._edge_triggered:
+                self._maybe_read_pending()
             self._maybe_add_error_listener()
 
     def set_close_callback(self, callback):
@@ -143,12 +180,15 @@ class IOStream(object):
                 callback = self._read_callback # 则将self._read_callback
                 self._read_callback = None     # 取出，
                 self._read_until_close = False # 并清除状态，然后将读buffer中的所有剩余内容交给回调
-                self._run_callback(callback, self._consume(self._read_buffer_size))
+                self._run_callback(callback, self._consume(self._read_buffer_size, self._read_as_view))
             if self._state is not None:        # 若self._state不为None，则还要从ioloop中remove掉
                 self.io_loop.remove_handler(self.socket.fileno())
                 self._state = None
             self.socket.close()                # 最后再关闭socket
             self.socket = None
+            if self._socket_close_callback is not None:
+                callback, self._socket_close_callback = self._socket_close_callback, None
+                callback()
         self._maybe_run_close_callback()       # 并试图调用关闭回调
 
     def _maybe_run_close_callback(self):
@@ -158,6 +198,17 @@ class IOStream(object):
             self._close_callback = None
             self._run_callback(cb)
 
+    def pause_reading(self):
+        """ 在下一次读操作之前不再从socket中读取数据。
+        平时没有读操作时iostream仍然监听可读事件（以便发现对端关闭），收到的数据都会放进_read_buffer，直到max_buffer_size；
+        暂停后数据留在内核的接收缓冲区中，TCP的流量控制会让对端暂停发送。暂停期间只能通过错误事件发现连接关闭。
+        调用read_xxx开始新的读操作时自动恢复读取。 """
+        self._read_paused = True
+        if (not self._edge_triggered and self._state is not None and
+            self._state & self.io_loop.READ and not self.reading()):
+            self._state &= ~self.io_loop.READ
+            self.io_loop.update_handler(self.socket.fileno(), self._state)
+
     def reading(self):
         """ 当_read_callback不为None时即在读 """
         return self._read_callback is not None
@@ -177,11 +228,14 @@ class IOStream(object):
             return
         try:
             if events & self.io_loop.READ:  # 如果发生了读事件，
-                self._handle_read()         # 则处理读，
+                self._readable = True
+                if self._wants_read():
+                    self._handle_read()     # 则处理读，
             if not self.socket:             # 处理读之后如果socket已被关闭则不用继续了；
                 return
 
             if events & self.io_loop.WRITE: # 如果发生了写事件，
+                self._writable = True
                 if self._connecting:        # 若self._connecting为True则表明当前正在连接中，
                     self._handle_connect()  # 则先完成连接，
                 self._handle_write()        # 再处理写，
@@ -195,13 +249,17 @@ class IOStream(object):
                 self.io_loop.add_callback(self.close)
                 return
 
+            if self._edge_triggered:        # 边缘触发模式下fd一次性注册了所有事件，不用update_handler，
+                self._maybe_read_pending()  # 只要处理之前因为在写而搁置的可读通知
+                return
+
             state = self.io_loop.ERROR
             if self.reading():
                 state |= self.io_loop.READ
             if self.writing():
                 state |= self.io_loop.WRITE
-            if state == self.io_loop.ERROR: # 若当前即不是reading()也不是writing()，
-                state |= self.io_loop.READ  # 则默认还是注册为感兴趣读
+            if state == self.io_loop.ERROR and not self._read_paused: # 若当前即不是reading()也不是writing()，
+                state |= self.io_loop.READ  # 则默认还是注册为感兴趣读（pause_reading之后除外）
             if state != self._state:        # 如果状态有变则更新该socket上的监听状态
                 assert self._state is not None, "shouldn't happen: _handle_events without self._state"
                 self._state = state
@@ -211,6 +269,17 @@ class IOStream(object):
             self.close()
             raise
 
+    def _wants_read(self):
+        """ 是否要处理可读通知。水平触发模式下只有注册了读才会收到通知，所以总是处理；
+        边缘触发模式下与水平触发注册读的条件一致：正在读，或者不在写也没有暂停读。 """
+        return not self._edge_triggered or self.reading() or not (self.writing() or self._read_paused)
+
+    def _maybe_read_pending(self):
+        """ 边缘触发模式下，若之前收到的可读通知因为在写而没有处理，现在不再写了，则把数据读出来。
+        因为不会再收到第二次通知，不在这里读的话对端关闭连接就发现不了。 """
+        if self._readable and self.socket is not None and self._wants_read():
+            self._handle_read()
+
     def _run_callback(self, callback, *args):
         def wrapper():
             self._pending_callbacks -= 1
@@ -238,9 +307,10 @@ class IOStream(object):
             try:
                 # 假装有一个pending，防止_read_to_buffer直接把连接关了。
                 self._pending_callbacks += 1
-                # 第一步：不断地读取网络数据以填充_read_buffer，直到阻塞或者EOF
+                # 第一步：不断地读取网络数据以填充_read_buffer，直到阻塞或者EOF（或者已经够read_bytes用了）
                 while True:
-                    if self._read_to_buffer() == 0:
+                    num_bytes = self._read_to_buffer()
+                    if num_bytes == 0 or self._read_target_reached(num_bytes):
                         break
             finally:
                 self._pending_callbacks -= 1
@@ -256,6 +326,7 @@ class IOStream(object):
 
     def _set_read_callback(self, callback):
         assert not self._read_callback, "Already reading" # 一次只能有一个读工作
+        self._read_paused = False
         self._read_callback = stack_context.wrap(callback)
 
     def _try_inline_read(self):
@@ -269,7 +340,8 @@ class IOStream(object):
         try:
             self._pending_callbacks += 1
             while True:
-                if self._read_to_buffer() == 0:
+                num_bytes = self._read_to_buffer()
+                if num_bytes == 0 or self._read_target_reached(num_bytes):
                     break
                 self._check_closed()
         finally:
@@ -279,42 +351,68 @@ class IOStream(object):
             return
         # 第四步：如果_read_buffer还是返回False就: 1.在关闭时调用下关闭回调; 2.否则在io_loop上注册读取通知;
         self._maybe_add_error_listener()
+        if self._state is not None: # pause_reading可能把读从注册的事件中去掉了
+            self._add_io_state(ioloop.IOLoop.READ)
+
+    def _read_target_reached(self, num_bytes):
+        """ 刚读到num_bytes字节后，是否可以不读到EAGAIN就停止从socket中读：没有读操作（读一次就足以发现对端关闭），
+        或者当前的read_bytes/read_until已经可以完成了。否则对端发送得快时会把之后的数据都读进内存，
+        调用者（如以流的方式读取请求体）无法控制内存占用。
+        没有读到EAGAIN时_readable仍为True，边缘触发模式下下一次读操作会继续读。 """
+        if self._read_callback is None:
+            return True
+        if self._read_bytes is not None:
+            return self._read_buffer_size >= self._read_bytes
+        if self._read_delimiter is not None:
+            if self._read_max_bytes is not None and self._read_buffer_size > self._read_max_bytes:
+                return True # 已经不可能在限制之内完成，不再继续读
+            # 只在新读到的数据（以及可能跨越边界的部分）中查找
+            start = max(self._read_buffer_pos, len(self._read_buffer) - num_bytes - len(self._read_delimiter) + 1)
+            return self._read_buffer.find(self._read_delimiter, start) != -1
+        return False
 
     def _read_from_socket(self):
-        """ 从socket中读取数据，并返回读到的字符串。只作为_read_to_buffer方法的辅助过程。 """
+        """ 从socket中读取数据，直接追加到_read_buffer的末尾，返回读到的字节数。只作为_read_to_buffer方法的辅助过程。 """
+        buf = self._read_buffer
+        end = len(buf)
+        # 先在_read_buffer末尾留出read_chunk_size字节的空间让recv_into直接写入，再去掉没有用到的部分。
+        # 不需要每个连接一直占用一块接收缓冲区，数据也不用再从那里复制一次（缩短bytearray不会重新分配内存）。
+        buf += _zeros(self.read_chunk_size)
         try:
             # 该方法是唯一真正从self.socket中读取数据的方法。
             # 注意到虽然self.socket是non-blocking的，但仍然是同步IO，
-            # 即self.socket.recv在无数据时会返回EAGAIN，有数据时直接读取并返回。
-            chunk = self.socket.recv(self.read_chunk_size)
+            # 即self.socket.recv_into在无数据时会返回EAGAIN，有数据时直接读取并返回。
+            num_bytes = self.socket.recv_into(memoryview(buf)[end:])
         except socket.error, e:
+            del buf[end:]
             if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                self._readable = False # 已经读空，等下一次可读通知
                 return None
             else:
                 raise
-        if not chunk: # EOF (FIN segment is received)
+        del buf[end + num_bytes:]
+        if not num_bytes: # EOF (FIN segment is received)
             self.close()
             return None
         # 若_read_from_socket返回了None，则根据self.closed()来判断是连接关闭还是无数据到达。
-        return chunk
+        return num_bytes
 
     def _read_to_buffer(self):
         """ 把从socket中读到的内容追加到_read_buffer中。返回读到的字节数。该方法会在多处被调用。 """
         try:
-            chunk = self._read_from_socket() # 从socket中读
+            num_bytes = self._read_from_socket() # 从socket中读，读到的内容已经追加到_read_buffer中
         except socket.error, e: # 这里的异常一定是异常，不会是WOULDBLOCK之类的
             logging.warning("Read error on %d: %s", self.socket.fileno(), e)
             self.close()
             raise
-        if chunk is None: # 返回None可能是因为无数据到达，或者另一端关闭了连接（该关闭的已经关闭，这里不用再处理）
+        if num_bytes is None: # 返回None可能是因为无数据到达，或者另一端关闭了连接（该关闭的已经关闭，这里不用再处理）
             return 0
-        self._read_buffer.append(chunk)                     # 把读到的内容追加到_read_buffer中
-        self._read_buffer_size += len(chunk)                # 更新_read_buffer_size
+        self._read_buffer_size += num_bytes                 # 更新_read_buffer_size
         if self._read_buffer_size >= self.max_buffer_size:  # _read_buffer_size一定不能超，否则直接抛异常
             logging.error("Reached maximum read buffer size")
             self.close()
             raise IOError("Reached maximum read buffer size")
-        return len(chunk)
+        return num_bytes
 
     def _read_from_buffer(self):
         """ 根据iostream当前状态试着从读buffer中完成读操作。该方法是主要读取方法，它负责调用当前设置的callback来完成读操作。
@@ -328,7 +426,8 @@ class IOStream(object):
                 # 如果要求读取固定字节数，则要么把_read_buffer读空，要么读满_read_bytes个字符，使_read_bytes变为0
                 bytes_to_consume = min(self._read_bytes, bytes_to_consume)
                 self._read_bytes -= bytes_to_consume
-            self._run_callback(self._streaming_callback, self._consume(bytes_to_consume)) # 把读的结果丢给_streaming_callback
+            # 把读的结果丢给_streaming_callback
+            self._run_callback(self._streaming_callback, self._consume(bytes_to_consume, self._read_as_view))
 
         # _streaming_callback只可能在read_bytes和read_until_close中被设置：
         # 1.read_bytes: 那么_read_bytes不为None，_read_buffer_size >= self._read_bytes可真可假:
@@ -342,39 +441,50 @@ class IOStream(object):
             self._read_callback = None      # 清空_read_callback
             self._streaming_callback = None # 清空了_streaming_callback, 因为这时调用的是read_bytes，再有数据到达时不当作流处理。
             self._read_bytes = None         # 清空_read_bytes
-            self._run_callback(callback, self._consume(num_bytes)) # 把_read_bytes个字符丢给callback
+            # 把_read_bytes个字符丢给callback
+            self._run_callback(callback, self._consume(num_bytes, self._read_as_view))
             return True
         elif self._read_delimiter is not None:
-            if self._read_buffer:
-                while True:
-                    loc = self._read_buffer[0].find(self._read_delimiter)
-                    if loc != -1:
-                        callback = self._read_callback
-                        delimiter_len = len(self._read_delimiter)
-                        self._read_callback = None      # 清空_read_callback
-                        self._streaming_callback = None # 清空_streaming_callback
-                        self._read_delimiter = None     # 清空_read_delimiter
-                        self._run_callback(callback, self._consume(loc + delimiter_len))
-                        return True
-                    if len(self._read_buffer) == 1:     # 如果_read_buffer所有的chunk都合并了还没找到就退出，返回False
-                        break
-                    _double_prefix(self._read_buffer)   # 合并_read_buffer的前面几个chunk
+            if self._read_buffer_size:
+                # 直接在整个读buffer中查找，不需要先把chunk合并
+                loc = self._read_buffer.find(self._read_delimiter, self._read_buffer_pos)
+                if loc != -1:
+                    size = loc - self._read_buffer_pos + len(self._read_delimiter)
+                    if self._read_max_bytes is not None and size > self._read_max_bytes:
+                        return self._read_limit_exceeded()
+                    callback = self._read_callback
+                    self._read_callback = None      # 清空_read_callback
+                    self._streaming_callback = None # 清空_streaming_callback
+                    self._read_delimiter = None     # 清空_read_delimiter
+                    self._read_max_bytes = None
+                    self._run_callback(callback, self._consume(size))
+                    return True
+                if self._read_max_bytes is not None and self._read_buffer_size >= self._read_max_bytes:
+                    return self._read_limit_exceeded()
         elif self._read_regex is not None:
-            if self._read_buffer:
-                while True:
-                    m = self._read_regex.search(self._read_buffer[0])
-                    if m is not None:
-                        callback = self._read_callback
-                        self._read_callback = None      # 清空_read_callback
-                        self._streaming_callback = None # 清空_streaming_callback
-                        self._read_regex = None         # 清空_read_regex
-                        self._run_callback(callback, self._consume(m.end()))
-                        return True
-                    if len(self._read_buffer) == 1:     # 如果_read_buffer所有的chunk都合并了还没找到就退出，返回False
-                        break
-                    _double_prefix(self._read_buffer)   # 合并_read_buffer的前面几个chunk
+            if self._read_buffer_size:
+                # 正则中的^只匹配真正的开头，所以先把已经消费的部分删掉
+                self._compact_read_buffer()
+                m = self._read_regex.search(self._read_buffer)
+                if m is not None:
+                    callback = self._read_callback
+                    self._read_callback = None      # 清空_read_callback
+                    self._streaming_callback = None # 清空_streaming_callback
+                    self._read_regex = None         # 清空_read_regex
+                    self._run_callback(callback, self._consume(m.end()))
+                    return True
         return False
 
+    def _read_limit_exceeded(self):
+        """ read_until超过了max_bytes：放弃这次读操作并关闭连接（关闭回调照常调用）。返回True，表示读操作已经处理完。 """
+        logging.info("Delimiter not found within %d bytes, closing connection", self._read_max_bytes)
+        self._read_callback = None
+        self._streaming_callback = None
+        self._read_delimiter = None
+        self._read_max_bytes = None
+        self.close()
+        return True
+
     def _handle_connect(self): # 处理连接事件，参见`man 2 connect` EINPROGRESS
         err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
         if err != 0: # 有错误
@@ -392,42 +502,144 @@ class IOStream(object):
         self._connecting = False # 完成连接
 
     def _handle_write(self):
-        while self._write_buffer:
+        while self._write_buffer and self.socket is not None:
+            if isinstance(self._write_buffer[0], _FileSegment):
+                more = self._handle_write_file()
+            elif self._vectored_write:
+                more = self._handle_write_vectored()
+            else:
+                more = self._handle_write_merged()
+            if not more:
+                break
+        if self.socket is None:
+            return
+        if not self._write_buffer and self._write_callback: # 如果数据已经发送完了，则调用_write_callback
+            callback = self._write_callback
+            self._write_callback = None
+            self._run_callback(callback)
+
+    # 以下三个_handle_write_xxx方法各自发送_write_buffer头部的一种数据，返回False表示暂时不能再写了（或者已经关闭）。
+
+    def _handle_write_vectored(self):
+        """ 把_write_buffer头部连续的多个字符串一次交给内核（分散写），部分发送时只移动_write_buffer_pos，不重新切分字符串。 """
+        while self._write_buffer and isinstance(self._write_buffer[0], bytes_type):
+            chunks = list(itertools.takewhile(lambda chunk: isinstance(chunk, bytes_type),
+                                              itertools.islice(self._write_buffer, _IOV_MAX)))
+            try:
+                num_bytes = _send_vectored(self.socket, chunks, self._write_buffer_pos)
+            except socket.error, e:
+                if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                    self._writable = False # 等下一次可写通知
+                    return False
+                else: # 真的错误
+                    logging.warning("Write error on %d: %s", self.socket.fileno(), e)
+                    self.close()
+                    return False
+            if num_bytes == 0:
+                self._writable = False
+                return False
+            pos = self._write_buffer_pos + num_bytes
+            while chunks and pos >= len(chunks[0]): # 把已经完整发送的chunk给pop掉
+                pos -= len(chunks.pop(0))
+                self._write_buffer.popleft()
+            self._write_buffer_pos = pos
+        return True
+
+    def _handle_write_file(self):
+        """ 发送_write_buffer头部的_FileSegment。 """
+        segment = self._write_buffer[0]
+        if not self._use_sendfile:
+            # 读出一块放到segment前面，由普通的写操作发送
+            segment.fileobj.seek(segment.offset)
+            data = segment.fileobj.read(min(segment.count, 128 * 1024))
+            if not data:
+                logging.warning("File ended %d bytes early in write_file", segment.count)
+                self.close()
+                return False
+            segment.offset += len(data)
+            segment.count -= len(data)
+            if not segment.count:
+                self._write_buffer.popleft()
+            self._write_buffer.appendleft(data)
+            return True
+        try:
+            num_bytes = _sendfile(self.socket.fileno(), segment.fileobj.fileno(), segment.offset, segment.count)
+        except (socket.error, OSError), e:
+            if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                self._writable = False # 等下一次可写通知
+            else:
+                logging.warning("Write error on %d: %s", self.socket.fileno(), e)
+                self.close()
+            return False
+        if num_bytes == 0: # 文件比count短（比如被截断了），无法再写出声明过的长度
+            logging.warning("File ended %d bytes early in write_file", segment.count)
+            self.close()
+            return False
+        segment.offset += num_bytes
+        segment.count -= num_bytes
+        if not segment.count:
+            self._write_buffer.popleft()
+        return True
+
+    def _handle_write_merged(self):
+        """ 每次把_write_buffer头部的字符串合并成一个再发送。SSL连接只能这样写。 """
+        while self._write_buffer and isinstance(self._write_buffer[0], bytes_type):
             try:
                 if not self._write_buffer_frozen:
                     # On windows, socket.send blows up if given a write buffer that's too large, instead of just returning the number
                     # of bytes it was able to process.  Therefore we must not call socket.send with more than 128KB at a time.
-                    _merge_prefix(self._write_buffer, 128 * 1024)
+                    # 合并时不能越过_write_buffer中的_FileSegment
+                    size = 0
+                    for chunk in self._write_buffer:
+                        if not isinstance(chunk, bytes_type) or size >= 128 * 1024:
+                            break
+                        size += len(chunk)
+                    _merge_prefix(self._write_buffer, min(size, 128 * 1024))
                 num_bytes = self.socket.send(self._write_buffer[0]) # 每次先试图发送_write_buffer的第一个chunk
                 if num_bytes == 0: # 若一个字都没发出去，则下次保持原样重发
                     # With OpenSSL, if we couldn't write the entire buffer, the very same string object must be used on the next call
                     # to send. Therefore we suppress merging the write buffer after an incomplete send. A cleaner solution would be to set
                     # SSL_MODE_ACCEPT_MOVING_WRITE_BUFFER, but this is not yet accessible from python (http://bugs.python.org/issue8240)
                     self._write_buffer_frozen = True
-                    break
+                    self._writable = False
+                    return False
                 self._write_buffer_frozen = False
                 _merge_prefix(self._write_buffer, num_bytes) # 这里只能把已经写到网络中的数据给pop掉
                 self._write_buffer.popleft()
             except socket.error, e:
                 if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                     self._write_buffer_frozen = True
-                    break
+                    self._writable = False # 等下一次可写通知
+                    return False
                 else: # 真的错误
                     logging.warning("Write error on %d: %s", self.socket.fileno(), e)
                     self.close()
-                    return
-        if not self._write_buffer and self._write_callback: # 如果循环退出时数据已经发送完了，则调用_write_callback
-            callback = self._write_callback
-            self._write_callback = None
-            self._run_callback(callback)
+                    return False
+        return True
 
-    def _consume(self, loc):
-        """ 从_read_buffer中消费loc个字符 """
+    def _consume(self, loc, as_view=False):
+        """ 从_read_buffer中消费loc个字符，返回字符串；as_view为True时返回memoryview """
         if loc == 0:
-            return b("")
-        _merge_prefix(self._read_buffer, loc) # 把前loc个字符调整到_read_buffer[0]的位置
-        self._read_buffer_size -= loc         # 调整_read_buffer_size
-        return self._read_buffer.popleft()    # 返回前loc个字符
+            return memoryview(b("")) if as_view else b("")
+        start = self._read_buffer_pos
+        self._read_buffer_size -= loc # 调整_read_buffer_size
+        if as_view:
+            view = memoryview(self._read_buffer)[start:start + loc]
+            # 交出去的view引用着整个bytearray，之后不能再修改它的大小，所以把剩下的数据（通常很少）搬到新的bytearray中
+            self._read_buffer = bytearray(memoryview(self._read_buffer)[start + loc:])
+            self._read_buffer_pos = 0
+            return view
+        data = memoryview(self._read_buffer)[start:start + loc].tobytes() # 只复制一次
+        self._read_buffer_pos += loc
+        if self._read_buffer_pos > self._read_buffer_size:
+            # 已消费的部分比剩下的多时才从头部删除，使搬移数据的均摊代价是线性的
+            self._compact_read_buffer()
+        return data
+
+    def _compact_read_buffer(self):
+        if self._read_buffer_pos:
+            del self._read_buffer[:self._read_buffer_pos]
+            self._read_buffer_pos = 0
 
     def _check_closed(self): # 若关闭则直接抛异常
         if not self.socket: # close方法中 self.socket = None
@@ -438,7 +650,7 @@ class IOStream(object):
             if self.socket is None: # 关闭时
                 self._maybe_run_close_callback()
             else: # 开始时
-                self._add_io_state(ioloop.IOLoop.READ)
+                self._add_io_state(0 if self._read_paused else ioloop.IOLoop.READ)
 
     def _add_io_state(self, state):
         # 在io_loop上注册事件通知(通过调用io_loop.add_handler)。
@@ -446,9 +658,14 @@ class IOStream(object):
         if self.socket is None:
             return
         if self._state is None:        # 之前没注册过，则直接将参数state与上ERROR注册
-            self._state = ioloop.IOLoop.ERROR | state
+            if self._edge_triggered:   # 边缘触发模式下一次性注册所有事件，以后不再修改
+                self._state = ioloop.IOLoop.ERROR | ioloop.IOLoop.READ | ioloop.IOLoop.WRITE
+                events = self._state | ioloop.IOLoop.EDGE
+            else:
+                self._state = ioloop.IOLoop.ERROR | state
+                events = self._state
             with stack_context.NullContext():
-                self.io_loop.add_handler(self.socket.fileno(), self._handle_events, self._state)
+                self.io_loop.add_handler(self.socket.fileno(), self._handle_events, events)
         elif not self._state & state:  # 已经注册过，但参数state与之前注册的不一样，则更新一下
             self._state = self._state | state
             self.io_loop.update_handler(self.socket.fileno(), self._state)
@@ -477,6 +694,11 @@ class SSLIOStream(IOStream):
         self._handshake_reading = False
         self._handshake_writing = False
         self._ssl_connect_callback = None
+        # SSL握手依赖于水平触发的重复通知，且OpenSSL内部还可能缓存着已解密的数据，所以SSL连接总是使用水平触发
+        self._edge_triggered = False
+        # 数据要经过OpenSSL加密，不能分散写，也不能sendfile；而且部分发送后必须用同一个字符串重试（见_handle_write_merged）
+        self._vectored_write = False
+        self._use_sendfile = False
 
     def reading(self):
         return self._handshake_reading or super(SSLIOStream, self).reading()
@@ -577,13 +799,91 @@ class SSLIOStream(IOStream):
         if not chunk:
             self.close()
             return None
-        return chunk
+        self._read_buffer += chunk
+        return len(chunk)
+
 
+class _FileSegment(object):
+    """ write_file放入_write_buffer中的一段文件，offset和count随着发送而更新。 """
+    __slots__ = ['fileobj', 'offset', 'count']
 
-def _double_prefix(deque):
-    """Grow by doubling, but don't split the second chunk just because the first one is small. """
-    new_len = max(len(deque[0])*2, (len(deque[0])+len(deque[1])))
-    _merge_prefix(deque, new_len)
+    def __init__(self, fileobj, offset, count):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.count = count
+
+
+# python2的socket和os模块没有sendmsg和sendfile，在Linux上通过ctypes从libc中取出writev(2)和sendfile(2)。
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+except Exception:
+    _libc = None
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise socket.error(err, os.strerror(err))
+
+
+# 分散写：一次系统调用发送chunks中的所有字符串（第一个从offset开始），返回发送的字节数。
+# 对socket来说writev与不带flags的sendmsg是等价的。
+_IOV_MAX = 64 # 一次最多发送的chunk数（Linux的IOV_MAX是1024）
+if hasattr(socket.socket, "sendmsg"): # python 3.3+
+    def _send_vectored(sock, chunks, offset):
+        chunks[0] = memoryview(chunks[0])[offset:]
+        return sock.sendmsg(chunks)
+elif hasattr(_libc, "writev"):
+    class _IOVec(ctypes.Structure):
+        _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+    _writev = _libc.writev
+    _writev.argtypes = [ctypes.c_int, ctypes.POINTER(_IOVec), ctypes.c_int]
+    _writev.restype = ctypes.c_ssize_t
+
+    def _send_vectored(sock, chunks, offset):
+        if len(chunks) == 1: # 只有一个chunk时send更快；buffer()不会复制数据
+            return sock.send(buffer(chunks[0], offset))
+        iov = (_IOVec * len(chunks))()
+        for i, chunk in enumerate(chunks):
+            # c_char_p直接指向str内部的数据，不会复制；chunk在调用期间由_write_buffer引用着
+            iov[i].iov_base = ctypes.cast(ctypes.c_char_p(chunk), ctypes.c_void_p).value
+            iov[i].iov_len = len(chunk)
+        iov[0].iov_base += offset
+        iov[0].iov_len -= offset
+        num_bytes = _writev(sock.fileno(), iov, len(chunks))
+        if num_bytes < 0:
+            _raise_errno()
+        return num_bytes
+else: # 只能先合并再send
+    _send_vectored = None
+
+# 把文件in_fd中从offset开始的最多count个字节直接发送到socket out_fd，返回发送的字节数。
+if hasattr(os, "sendfile"): # python 3.3+
+    _sendfile = os.sendfile
+elif hasattr(_libc, "sendfile64"):
+    _c_sendfile = _libc.sendfile64
+    _c_sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    _c_sendfile.restype = ctypes.c_ssize_t
+
+    def _sendfile(out_fd, in_fd, offset, count):
+        num_bytes = _c_sendfile(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)), min(count, 0x7ffff000))
+        if num_bytes < 0:
+            _raise_errno()
+        return num_bytes
+else:
+    _sendfile = None
+
+
+_zero_chunks = {}
+
+def _zeros(size):
+    """ 返回size个0字节组成的字符串，各个IOStream共用。 """
+    chunk = _zero_chunks.get(size)
+    if chunk is None:
+        chunk = _zero_chunks[size] = b("\0") * size
+    return chunk
 
 
 def _merge_prefix(deque, size):
@@ -2,16 +2,22 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import collections
 import errno
+import functools
 import logging
 import os
 import socket
 import stat
+import threading
+import time
 
 from tornado import process
+from tornado import stack_context
 from tornado.ioloop import IOLoop
 from tornado.iostream import IOStream, SSLIOStream
 from tornado.platform.auto import set_close_exec
+from tornado.util import raise_exc_info
 
 try:
     import ssl  # Python 2.6+
@@ -20,13 +26,24 @@ except ImportError:
 
 
 class TCPServer(object):
-    """ 非阻塞、单线程的TCP服务器。 """
-    def __init__(self, io_loop=None, ssl_options=None):
+    """ 非阻塞、单线程的TCP服务器。
+    每次监听socket可读时最多accept accept_batch_size个连接，剩下的留到IOLoop的下一轮，以免大量新连接使正在处理的请求得不到处理。
+    打开的连接达到max_connections时暂时不再监听（而不是accept之后再关闭）监听socket，新连接留在内核的backlog中，
+    有连接关闭后再继续accept。open_connections、accepted_connections和rejected_connections分别是当前打开的连接数、
+    accept的连接总数以及accept之后因为SSL握手之前的错误或者handle_stream出错而关闭的连接数。 """
+    def __init__(self, io_loop=None, ssl_options=None, max_connections=None, accept_batch_size=128):
         self.io_loop = io_loop
         self.ssl_options = ssl_options
+        self.max_connections = max_connections
+        self.accept_batch_size = accept_batch_size
+        self.open_connections = 0
+        self.accepted_connections = 0
+        self.rejected_connections = 0
         self._sockets = {}  # fd -> socket object
         self._pending_sockets = []
         self._started = False
+        self._accepting = True # 监听socket是否注册在IOLoop中（没有因为max_connections而暂停）
+        self._stopped = False
 
         # Verify the SSL options. Otherwise we don't get errors until clients connect.
         # This doesn't verify that the keys are legitimate, but the SSL module doesn't do
@@ -51,7 +68,15 @@ class TCPServer(object):
             self.io_loop = IOLoop.instance()
         for sock in sockets:
             self._sockets[sock.fileno()] = sock
-            add_accept_handler(sock, self._handle_connection, io_loop=self.io_loop)
+            if self._accepting:
+                self._add_accept_handler(sock)
+
+    def _add_accept_handler(self, sock):
+        add_accept_handler(sock, self._handle_connection, io_loop=self.io_loop,
+                           batch_size=self.accept_batch_size, can_accept=self._can_accept)
+
+    def _can_accept(self):
+        return self._accepting
 
     def add_socket(self, socket):
         """ Singular version of `add_sockets`.  Takes a single socket object. """
@@ -117,36 +142,71 @@ class TCPServer(object):
         server is stopped.
         """
         for fd, sock in self._sockets.iteritems():
-            self.io_loop.remove_handler(fd)
+            if self._accepting:
+                self.io_loop.remove_handler(fd)
             sock.close()
+        self._stopped = True
 
     def handle_stream(self, stream, address):
         """Override to handle a new `IOStream` from an incoming connection."""
         raise NotImplementedError()
 
     def _handle_connection(self, connection, address): # connection, address是socket.accept()的返回结果
+        self.accepted_connections += 1
         if self.ssl_options is not None:
             assert ssl, "Python 2.6+ and OpenSSL required for SSL"
             try:
                 connection = ssl.wrap_socket(connection, server_side=True, do_handshake_on_connect=False, **self.ssl_options)
             except ssl.SSLError, err:
                 if err.args[0] == ssl.SSL_ERROR_EOF:
+                    self.rejected_connections += 1
                     return connection.close()
                 else:
                     raise
             except socket.error, err:
                 if err.args[0] == errno.ECONNABORTED:
+                    self.rejected_connections += 1
                     return connection.close()
                 else:
                     raise
+        stream = None
         try:
             if self.ssl_options is not None:
                 stream = SSLIOStream(connection, io_loop=self.io_loop)
             else:
                 stream = IOStream(connection, io_loop=self.io_loop) # 把新的socket包装成一个stream
+            self.open_connections += 1
+            stream._socket_close_callback = self._on_connection_closed
+            if self.max_connections is not None and self.open_connections >= self.max_connections:
+                self._pause_accepting()
             self.handle_stream(stream, address)
         except Exception:
             logging.error("Error in connection callback", exc_info=True)
+            self.rejected_connections += 1
+            if stream is not None:
+                stream.close()
+            else:
+                connection.close()
+
+    def _on_connection_closed(self):
+        self.open_connections -= 1
+        if (not self._accepting and not self._stopped and
+            (self.max_connections is None or self.open_connections < self.max_connections)):
+            self._resume_accepting()
+
+    def _pause_accepting(self):
+        """ 连接数达到上限：把监听socket从IOLoop中移除，新连接留在backlog中。 """
+        if self._accepting and not self._stopped:
+            self._accepting = False
+            for fd in self._sockets:
+                self.io_loop.remove_handler(fd)
+
+    def _resume_accepting(self):
+        self._accepting = True
+        # 通常是在某个请求的handler中关闭连接时调用的，accept handler不能带上那个请求的StackContext
+        with stack_context.NullContext():
+            for sock in self._sockets.itervalues():
+                self._add_accept_handler(sock)
 
 
 def bind_sockets(port, address=None, family=socket.AF_UNSPEC, backlog=128):
@@ -210,17 +270,124 @@ if hasattr(socket, 'AF_UNIX'):
         return sock
 
 
-def add_accept_handler(sock, callback, io_loop=None):
-    """ 添加一个IOLoop事件handler以处理该sock上的新连接。 """
+def add_accept_handler(sock, callback, io_loop=None, batch_size=128, can_accept=None):
+    """ 添加一个IOLoop事件handler以处理该sock上的新连接。
+    每次可读事件最多accept batch_size个连接（为None时不限制），监听socket是水平触发的，剩下的连接在IOLoop的下一轮再accept。
+    can_accept不为None时，每次accept之前调用它，返回False时停止这一批。 """
     if io_loop is None:
         io_loop = IOLoop.instance()
     def accept_handler(fd, events):
-        while True:
+        accepted = 0
+        while batch_size is None or accepted < batch_size:
+            if can_accept is not None and not can_accept():
+                return
             try:
                 connection, address = sock.accept()
             except socket.error, e:
                 if e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
                     return # 当前没有连接（即建立连接会阻塞），则直接返回
+                if e.args[0] == errno.ECONNABORTED:
+                    continue # 连接在accept之前已经被客户端重置
                 raise
+            accepted += 1
             callback(connection, address) # 建立连接后以(connection, address)来调用回调函数
     io_loop.add_handler(sock.fileno(), accept_handler, IOLoop.READ)
+
+
+class Resolver(object):
+    """ 异步DNS解析器的接口，由SimpleAsyncHTTPClient使用。 """
+    def resolve(self, host, port, family, callback):
+        """ 解析host和port，以socket.getaddrinfo(host, port, family, socket.SOCK_STREAM)的结果调用callback。
+        解析失败时，异常（通常是socket.gaierror）会在调用resolve时的StackContext中抛出。 """
+        raise NotImplementedError()
+
+
+class ThreadedResolver(Resolver):
+    """ 在线程池中调用阻塞的socket.getaddrinfo，使慢的DNS服务器不会阻塞IOLoop。
+    未指定executor时，所有的ThreadedResolver共享一个小的线程池。IP地址不用查询，直接在IOLoop线程中解析。 """
+    _threadpool = None
+    _threadpool_lock = threading.Lock()
+
+    def __init__(self, io_loop=None, executor=None, num_threads=4):
+        self.io_loop = io_loop or IOLoop.instance()
+        self.executor = executor or ThreadedResolver._shared_threadpool(num_threads)
+
+    @staticmethod
+    def _shared_threadpool(num_threads):
+        with ThreadedResolver._threadpool_lock:
+            if ThreadedResolver._threadpool is None:
+                from tornado.executor import ThreadPoolExecutor
+                ThreadedResolver._threadpool = ThreadPoolExecutor(max_workers=num_threads)
+            return ThreadedResolver._threadpool
+
+    def resolve(self, host, port, family, callback):
+        try:
+            addrinfo = socket.getaddrinfo(host, port, family, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+        except socket.gaierror: # 不是IP地址，要到线程池中查询
+            self.io_loop.run_in_executor(self.executor, socket.getaddrinfo, host, port, family, socket.SOCK_STREAM,
+                                         0, 0, callback=callback)
+        else:
+            self.io_loop.add_callback(functools.partial(callback, addrinfo))
+
+
+class CachingResolver(Resolver):
+    """ 给另一个Resolver加上内存缓存。
+    getaddrinfo不会返回DNS记录的TTL，所以成功的结果统一缓存ttl秒；解析失败(socket.gaierror)缓存negative_ttl秒。
+    同一个(host, port, family)同时只会有一次正在进行的查询，其间到来的请求都等待这次查询的结果。 """
+    def __init__(self, resolver, io_loop=None, ttl=300, negative_ttl=30, max_entries=1024):
+        self.resolver = resolver
+        self.io_loop = io_loop or IOLoop.instance()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._cache = collections.OrderedDict() # (host, port, family) -> (过期时间, addrinfo, exc_info)
+        self._waiting = {}                      # (host, port, family) -> [(callback, reraise)]，正在查询中的请求
+
+    def resolve(self, host, port, family, callback):
+        key = (host, port, family)
+        entry = self._cache.get(key)
+        if entry is not None:
+            expires, addrinfo, exc_info = entry
+            if expires > time.time():
+                if exc_info is None:
+                    self.io_loop.add_callback(functools.partial(callback, addrinfo))
+                else:
+                    self.io_loop.add_callback(functools.partial(raise_exc_info, exc_info))
+                return
+            del self._cache[key]
+        waiter = (stack_context.wrap(callback), stack_context.wrap(raise_exc_info))
+        if key in self._waiting: # 已经有相同的查询在进行了
+            self._waiting[key].append(waiter)
+            return
+        self._waiting[key] = [waiter]
+
+        def handle_exception(typ, value, tb):
+            self._finish(key, None, (typ, value, tb))
+            return True
+        # 这次查询被所有的等待者共享，不属于任何一个请求的StackContext
+        with stack_context.NullContext():
+            with stack_context.ExceptionStackContext(handle_exception):
+                self.resolver.resolve(host, port, family, functools.partial(self._finish, key, exc_info=None))
+
+    def _finish(self, key, addrinfo, exc_info):
+        if exc_info is None:
+            self._store(key, (time.time() + self.ttl, addrinfo, None))
+        elif isinstance(exc_info[1], socket.gaierror):
+            # 不保存traceback，以免缓存中的记录引用着整个调用栈
+            self._store(key, (time.time() + self.negative_ttl, None, (exc_info[0], exc_info[1], None)))
+        with stack_context.NullContext():
+            for callback, reraise in self._waiting.pop(key, ()):
+                if exc_info is None:
+                    self.io_loop.add_callback(functools.partial(callback, addrinfo))
+                else:
+                    self.io_loop.add_callback(functools.partial(reraise, exc_info))
+
+    def _store(self, key, entry):
+        if len(self._cache) >= self.max_entries:
+            now = time.time()
+            for k, v in self._cache.items(): # 先清掉过期的记录
+                if v[0] <= now:
+                    del self._cache[k]
+            while len(self._cache) >= self.max_entries: # 还是太多，则淘汰最早加入的记录
+                self._cache.popitem(last=False)
+        self._cache[key] = entry
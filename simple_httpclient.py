@@ -6,6 +6,7 @@ from tornado.escape import utf8, _unicode, native_str
 from tornado.httpclient import HTTPRequest, HTTPResponse, HTTPError, AsyncHTTPClient, main
 from tornado.httputil import HTTPHeaders
 from tornado.iostream import IOStream, SSLIOStream
+from tornado.netutil import CachingResolver, ThreadedResolver
 from tornado import stack_context
 from tornado.util import b, GzipDecompressor
 
@@ -37,16 +38,39 @@ _DEFAULT_CA_CERTS = os.path.dirname(__file__) + '/ca-certificates.crt'
 
 class SimpleAsyncHTTPClient(AsyncHTTPClient):
     """ 没有外部依赖的非阻塞HTTP客户端。 """
-    def initialize(self, io_loop=None, max_clients=10, hostname_mapping=None, max_buffer_size=104857600):
+    def initialize(self, io_loop=None, max_clients=10, hostname_mapping=None, max_buffer_size=104857600, resolver=None,
+                   max_idle_per_host=0, idle_timeout=30, max_requests_per_connection=100,
+                   max_clients_per_host=None, queue_timeout=None):
         """ 创建一个AsyncHTTPClient实例。
         每个IOLoop上只存在单个AsyncHTTPClient实例，从而可以限制pending的连接的数量。force_instance=True可以禁止这项特性。
-        max_clients是进程中可以存在的并发请求数，只在client第一次被创建时有效，之后复用client时该参数会被忽略。 """
+        max_clients是进程中可以存在的并发请求数，只在client第一次被创建时有效，之后复用client时该参数会被忽略。
+        hostname_mapping是一个host到host（或IP）的静态映射，在DNS解析之前生效。
+        resolver是一个tornado.netutil.Resolver，默认在线程池中解析并缓存结果（CachingResolver+ThreadedResolver）。
+        完成的keep-alive连接会按(scheme, host, port)放入连接池pool中复用：每个key最多保存max_idle_per_host个空闲连接，
+        空闲超过idle_timeout秒的连接会被关闭（应小于服务器端的keep-alive超时），一个连接最多发送max_requests_per_connection个请求。
+        默认max_idle_per_host=0，不复用连接，每个请求都带上Connection: close。开启连接池后，复用的连接在收到响应之前
+        就被服务器关闭时，幂等的请求（GET、HEAD、PUT、DELETE、OPTIONS）会在新建的连接上重试一次；
+        处理这类请求有副作用的服务器可能因此收到两次请求，所以连接池需要显式开启。
+        max_clients_per_host限制对同一个host的并发请求数（默认不限制），超过max_clients或者max_clients_per_host的请求
+        按host分别排队，各个host轮流出队，所以一个慢的host不会饿死发往其它host的请求。
+        queue_timeout不为None时，排队超过queue_timeout秒的请求直接以599失败。 """
         self.io_loop = io_loop
         self.max_clients = max_clients
-        self.queue = collections.deque()
+        self.max_clients_per_host = max_clients_per_host
+        self.queue_timeout = queue_timeout
+        self.queue = _FairQueue()
         self.active = {}
+        self._active_per_host = {} # host -> 该host上正在进行的请求数
         self.hostname_mapping = hostname_mapping
         self.max_buffer_size = max_buffer_size
+        if resolver is None:
+            resolver = CachingResolver(ThreadedResolver(io_loop=io_loop), io_loop=io_loop)
+        self.resolver = resolver
+        self.pool = _ConnectionPool(io_loop, max_idle_per_host, idle_timeout, max_requests_per_connection)
+
+    def close(self):
+        super(SimpleAsyncHTTPClient, self).close()
+        self.pool.close()
 
     def fetch(self, request, callback, **kwargs):
         if not isinstance(request, HTTPRequest):
@@ -55,27 +79,176 @@ class SimpleAsyncHTTPClient(AsyncHTTPClient):
         # This is also where normal dicts get converted to HTTPHeaders objects.
         request.headers = HTTPHeaders(request.headers)
         callback = stack_context.wrap(callback)
-        self.queue.append((request, callback))
-        self._process_queue()
-        if self.queue:
-            logging.debug("max_clients limit reached, request queued. %d active, %d queued requests."
-                    % (len(self.active), len(self.queue)))
+        host = urlparse.urlsplit(_unicode(request.url)).netloc.rpartition("@")[-1]
+        # 每次有请求结束时都会调用_process_queue，所以队列中的请求都是因为限制而不能开始的，
+        # 新的请求只要没有达到限制就可以直接开始，不会越过其它可以开始的请求
+        if len(self.active) < self.max_clients and self._host_available(host):
+            with stack_context.NullContext():
+                self._start_fetch(request, callback, host)
+            return
+        item = _QueuedRequest(request, callback, host)
+        if self.queue_timeout is not None:
+            item.timeout = self.io_loop.add_timeout(item.queue_start + self.queue_timeout,
+                                                    functools.partial(self._on_queue_timeout, item))
+        self.queue.append(host, item)
+        logging.debug("max_clients limit reached, request queued. %d active, %d queued requests."
+                % (len(self.active), len(self.queue)))
+
+    def _host_available(self, host):
+        return self.max_clients_per_host is None or self._active_per_host.get(host, 0) < self.max_clients_per_host
 
     def _process_queue(self):
         with stack_context.NullContext():
             while self.queue and len(self.active) < self.max_clients:
-                request, callback = self.queue.popleft()
-                key = object()
-                self.active[key] = (request, callback)
-                _HTTPConnection(self.io_loop, self, request, functools.partial(self._release_fetch, key), callback, self.max_buffer_size)
-
-    def _release_fetch(self, key):
+                item = self.queue.popleft(self._host_available)
+                if item is None: # 排队的host都达到了max_clients_per_host
+                    break
+                if item.timeout is not None:
+                    self.io_loop.remove_timeout(item.timeout)
+                self._start_fetch(item.request, item.callback, item.host)
+
+    def _start_fetch(self, request, callback, host):
+        key = object()
+        self.active[key] = (request, callback)
+        self._active_per_host[host] = self._active_per_host.get(host, 0) + 1
+        _HTTPConnection(self.io_loop, self, request, functools.partial(self._release_fetch, key, host), callback, self.max_buffer_size)
+
+    def _release_fetch(self, key, host):
         del self.active[key]
+        self._active_per_host[host] -= 1
+        if not self._active_per_host[host]:
+            del self._active_per_host[host]
         self._process_queue()
 
+    def _on_queue_timeout(self, item):
+        self.queue.remove(item.host, item)
+        waited = time.time() - item.queue_start
+        item.callback(HTTPResponse(item.request, 599, error=HTTPError(599, "Timeout in request queue"),
+                                   request_time=waited, time_info={"queue": waited}))
+
+
+class _QueuedRequest(object):
+    """ 因为并发限制而在排队的请求。 """
+    __slots__ = ['request', 'callback', 'host', 'queue_start', 'timeout']
+
+    def __init__(self, request, callback, host):
+        self.request = request
+        self.callback = callback
+        self.host = host
+        self.queue_start = time.time()
+        self.timeout = None # queue_timeout对应的Timeout句柄
+
+
+class _FairQueue(object):
+    """ 每个host一个FIFO队列，出队时在各个host之间轮转。 """
+    def __init__(self):
+        self._queues = collections.OrderedDict() # host -> deque，按轮转的顺序排列
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def append(self, host, item):
+        queue = self._queues.get(host)
+        if queue is None:
+            queue = self._queues[host] = collections.deque()
+        queue.append(item)
+        self._size += 1
+
+    def remove(self, host, item):
+        queue = self._queues[host]
+        queue.remove(item)
+        if not queue:
+            del self._queues[host]
+        self._size -= 1
+
+    def popleft(self, available):
+        """ 从第一个available(host)为真的host的队列中取出最早的一项，并把这个host移到轮转的末尾。
+        没有这样的host时返回None。 """
+        for host in self._queues:
+            if available(host):
+                break
+        else:
+            return None
+        queue = self._queues.pop(host)
+        item = queue.popleft()
+        if queue:
+            self._queues[host] = queue
+        self._size -= 1
+        return item
+
+
+class _ConnectionPool(object):
+    """ 按(scheme, host, port)保存空闲的keep-alive连接。
+    hits和misses分别是从池中取到和没有取到空闲连接的次数。 """
+    def __init__(self, io_loop, max_idle_per_host, idle_timeout, max_requests_per_connection):
+        self.io_loop = io_loop
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.max_requests_per_connection = max_requests_per_connection
+        self.hits = 0
+        self.misses = 0
+        self._idle = {} # key -> [[stream, 已发送的请求数, 空闲超时的Timeout句柄], ...]，最近放回的在最后
+
+    def idle_count(self):
+        """ 返回池中空闲连接的总数。 """
+        return sum(len(idle) for idle in self._idle.itervalues())
+
+    def get(self, key):
+        """ 取出一个空闲连接，返回(stream, 该连接已经发送过的请求数)，没有可用的连接时返回(None, 0)。 """
+        idle = self._idle.get(key)
+        while idle:
+            stream, num_requests, timeout = idle.pop()
+            self.io_loop.remove_timeout(timeout)
+            # 空闲期间收到了数据的连接已经不能再用来解析下一个响应
+            if not stream.closed() and not stream._read_buffer_size:
+                if not idle:
+                    del self._idle[key]
+                self.hits += 1
+                return stream, num_requests
+            stream.close()
+        self._idle.pop(key, None)
+        self.misses += 1
+        return None, 0
+
+    def put(self, key, stream, num_requests):
+        """ 把一个已经读完响应的连接放回池中，超过限制时直接关闭它。 """
+        idle = self._idle.get(key, [])
+        if (stream.closed() or num_requests >= self.max_requests_per_connection or
+            len(idle) >= self.max_idle_per_host):
+            stream.close()
+            return
+        entry = [stream, num_requests, None]
+        # 池中的连接由之后的请求共享，不能带着放回它的那个请求的StackContext
+        with stack_context.NullContext():
+            discard = functools.partial(self._discard, key, entry)
+            entry[2] = self.io_loop.add_timeout(time.time() + self.idle_timeout, discard)
+            stream.set_close_callback(discard) # 对端关闭空闲连接时从池中移除
+        self._idle.setdefault(key, []).append(entry)
+
+    def close(self):
+        """ 关闭池中所有的空闲连接。 """
+        idle, self._idle = self._idle, {}
+        for entries in idle.itervalues():
+            for stream, num_requests, timeout in entries:
+                self.io_loop.remove_timeout(timeout)
+                stream.close()
+
+    def _discard(self, key, entry):
+        idle = self._idle.get(key, [])
+        for i, e in enumerate(idle):
+            if e is entry:
+                del idle[i]
+                if not idle:
+                    del self._idle[key]
+                break
+        self.io_loop.remove_timeout(entry[2])
+        entry[0].close()
+
 
 class _HTTPConnection(object):
     _SUPPORTED_METHODS = set(["GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
+    _IDEMPOTENT_METHODS = set(["GET", "HEAD", "PUT", "DELETE", "OPTIONS"])
 
     def __init__(self, io_loop, client, request, release_callback, final_callback, max_buffer_size):
         self.start_time = time.time()
@@ -84,11 +257,15 @@ class _HTTPConnection(object):
         self.request = request
         self.release_callback = release_callback
         self.final_callback = final_callback
+        self.max_buffer_size = max_buffer_size
         self.code = None
         self.headers = None
         self.chunks = None
         self._decompressor = None
         self._timeout = None # 由IOLoop.add_timeout返回的Timeout句柄
+        self._pool_key = None # 连接池中的key
+        self._num_requests = 0 # 在使用的连接此前已经发送过的请求数，大于0表示这是从连接池中取出的连接
+        self._keep_alive = False # 响应结束后能否把连接放回连接池
         with stack_context.StackContext(self.cleanup):
             parsed = urlparse.urlsplit(_unicode(self.request.url))
             if ssl is None and parsed.scheme == "https":
@@ -117,50 +294,68 @@ class _HTTPConnection(object):
             else: # We only try the first IP we get from getaddrinfo, so restrict to ipv4 by default.
                 af = socket.AF_INET
 
-            addrinfo = socket.getaddrinfo(host, port, af, socket.SOCK_STREAM, 0, 0)
-            af, socktype, proto, canonname, sockaddr = addrinfo[0]
-
-            if parsed.scheme == "https":
-                ssl_options = {}
-                if request.validate_cert:
-                    ssl_options["cert_reqs"] = ssl.CERT_REQUIRED
-                if request.ca_certs is not None:
-                    ssl_options["ca_certs"] = request.ca_certs
-                else:
-                    ssl_options["ca_certs"] = _DEFAULT_CA_CERTS
-                if request.client_key is not None:
-                    ssl_options["keyfile"] = request.client_key
-                if request.client_cert is not None:
-                    ssl_options["certfile"] = request.client_cert
-
-                # SSL interoperability is tricky.  We want to disable
-                # SSLv2 for security reasons; it wasn't disabled by default
-                # until openssl 1.0.  The best way to do this is to use
-                # the SSL_OP_NO_SSLv2, but that wasn't exposed to python
-                # until 3.2.  Python 2.7 adds the ciphers argument, which
-                # can also be used to disable SSLv2.  As a last resort
-                # on python 2.6, we set ssl_version to SSLv3.  This is
-                # more narrow than we'd like since it also breaks
-                # compatibility with servers configured for TLSv1 only,
-                # but nearly all servers support SSLv3:
-                # http://blog.ivanristic.com/2011/09/ssl-survey-protocol-support.html
-                if sys.version_info >= (2, 7):
-                    ssl_options["ciphers"] = "DEFAULT:!SSLv2"
-                else:
-                    # This is really only necessary for pre-1.0 versions
-                    # of openssl, but python 2.6 doesn't expose version
-                    # information.
-                    ssl_options["ssl_version"] = ssl.PROTOCOL_SSLv3
-
-                self.stream = SSLIOStream(socket.socket(af, socktype, proto),
-                                          io_loop=self.io_loop, ssl_options=ssl_options, max_buffer_size=max_buffer_size)
-            else:
-                self.stream = IOStream(socket.socket(af, socktype, proto), io_loop=self.io_loop, max_buffer_size=max_buffer_size)
+            # 超时从这里开始计算，使DNS解析的时间也计入connect_timeout
             timeout = min(request.connect_timeout, request.request_timeout)
             if timeout:
                 self._timeout = self.io_loop.add_timeout(self.start_time+timeout, stack_context.wrap(self._on_timeout))
-            self.stream.set_close_callback(self._on_close)
-            self.stream.connect(sockaddr, functools.partial(self._on_connect, parsed, parsed_hostname))
+            self._resolve_args = (host, port, af, parsed, parsed_hostname) # 复用的连接失效时用来重新建立连接
+            if self.client.pool.max_idle_per_host:
+                self._pool_key = (parsed.scheme, parsed_hostname, port)
+                if parsed.scheme == "https": # 证书相关的选项不同的请求不能共用同一个SSL连接
+                    self._pool_key += (request.validate_cert, request.ca_certs, request.client_key, request.client_cert)
+                stream, self._num_requests = self.client.pool.get(self._pool_key)
+                if stream is not None:
+                    self.stream = stream
+                    self.stream.set_close_callback(self._on_close)
+                    self.io_loop.add_callback(functools.partial(self._on_connect, parsed, parsed_hostname))
+                    return
+            self.client.resolver.resolve(host, port, af, functools.partial(self._on_resolve, parsed, parsed_hostname))
+
+    def _on_resolve(self, parsed, parsed_hostname, addrinfo):
+        if self.final_callback is None: # 在DNS解析期间已经超时了
+            return
+        af, socktype, proto, canonname, sockaddr = addrinfo[0]
+        request = self.request
+        max_buffer_size = self.max_buffer_size
+
+        if parsed.scheme == "https":
+            ssl_options = {}
+            if request.validate_cert:
+                ssl_options["cert_reqs"] = ssl.CERT_REQUIRED
+            if request.ca_certs is not None:
+                ssl_options["ca_certs"] = request.ca_certs
+            else:
+                ssl_options["ca_certs"] = _DEFAULT_CA_CERTS
+            if request.client_key is not None:
+                ssl_options["keyfile"] = request.client_key
+            if request.client_cert is not None:
+                ssl_options["certfile"] = request.client_cert
+
+            # SSL interoperability is tricky.  We want to disable
+            # SSLv2 for security reasons; it wasn't disabled by default
+            # until openssl 1.0.  The best way to do this is to use
+            # the SSL_OP_NO_SSLv2, but that wasn't exposed to python
+            # until 3.2.  Python 2.7 adds the ciphers argument, which
+            # can also be used to disable SSLv2.  As a last resort
+            # on python 2.6, we set ssl_version to SSLv3.  This is
+            # more narrow than we'd like since it also breaks
+            # compatibility with servers configured for TLSv1 only,
+            # but nearly all servers support SSLv3:
+            # http://blog.ivanristic.com/2011/09/ssl-survey-protocol-support.html
+            if sys.version_info >= (2, 7):
+                ssl_options["ciphers"] = "DEFAULT:!SSLv2"
+            else:
+                # This is really only necessary for pre-1.0 versions
+                # of openssl, but python 2.6 doesn't expose version
+                # information.
+                ssl_options["ssl_version"] = ssl.PROTOCOL_SSLv3
+
+            self.stream = SSLIOStream(socket.socket(af, socktype, proto),
+                                      io_loop=self.io_loop, ssl_options=ssl_options, max_buffer_size=max_buffer_size)
+        else:
+            self.stream = IOStream(socket.socket(af, socktype, proto), io_loop=self.io_loop, max_buffer_size=max_buffer_size)
+        self.stream.set_close_callback(self._on_close)
+        self.stream.connect(sockaddr, functools.partial(self._on_connect, parsed, parsed_hostname))
 
     def _on_timeout(self):
         self._timeout = None
@@ -186,7 +381,7 @@ class _HTTPConnection(object):
         for key in ('network_interface', 'proxy_host', 'proxy_port', 'proxy_username', 'proxy_password'):
             if getattr(self.request, key, None):
                 raise NotImplementedError('%s not supported' % key)
-        if "Connection" not in self.request.headers:
+        if "Connection" not in self.request.headers and self._pool_key is None:
             self.request.headers["Connection"] = "close"
         if "Host" not in self.request.headers:
             if '@' in parsed.netloc:
@@ -254,12 +449,22 @@ class _HTTPConnection(object):
                 self.stream.close()
 
     def _on_close(self):
+        if self.final_callback is not None and self._can_retry():
+            # 从连接池取出的连接可能在复用的同时被服务器关闭（空闲超时），还没有收到任何响应时换一个新连接重试一次
+            self._num_requests = 0
+            host, port, af, parsed, parsed_hostname = self._resolve_args
+            self.client.resolver.resolve(host, port, af, functools.partial(self._on_resolve, parsed, parsed_hostname))
+            return
         if self.final_callback is not None:
             message = "Connection closed"
             if self.stream.error:
                 message = str(self.stream.error)
             raise HTTPError(599, message)
 
+    def _can_retry(self):
+        return (self._num_requests > 0 and self.code is None and not self.stream._read_buffer_size and
+                self.request.method in self._IDEMPOTENT_METHODS)
+
     def _on_headers(self, data):
         data = native_str(data.decode("latin1"))
         first_line, _, header_data = data.partition("\n")
@@ -273,6 +478,7 @@ class _HTTPConnection(object):
             self.code = code
 
         self.headers = HTTPHeaders.parse(header_data)
+        self._keep_alive = self._can_keep_alive(first_line)
 
         if "Content-Length" in self.headers:
             if "," in self.headers["Content-Length"]:
@@ -316,8 +522,25 @@ class _HTTPConnection(object):
         elif content_length is not None:
             self.stream.read_bytes(content_length, self._on_body)
         else:
+            self._keep_alive = False # 只能以关闭连接来表示响应结束
             self.stream.read_until_close(self._on_body)
 
+    def _can_keep_alive(self, first_line):
+        """ 根据请求和响应的Connection头判断连接能否在响应结束后放回连接池。 """
+        if self._pool_key is None or self.request.headers.get("Connection", "").lower() == "close":
+            return False
+        connection = self.headers.get("Connection", "").lower()
+        if first_line.startswith("HTTP/1.1"):
+            return connection != "close"
+        return connection == "keep-alive"
+
+    def _release_stream(self):
+        """ 响应已经完整读完，把连接放回连接池，不能复用时关闭。 """
+        if self._keep_alive:
+            self.client.pool.put(self._pool_key, self.stream, self._num_requests + 1)
+        else:
+            self.stream.close()
+
     def _on_body(self, data):
         if self._timeout is not None:
             self.io_loop.remove_timeout(self._timeout)
@@ -347,8 +570,8 @@ class _HTTPConnection(object):
             final_callback = self.final_callback
             self.final_callback = None
             self._release()
+            self._release_stream() # 先放回连接池，重定向到同一个host时可以直接复用
             self.client.fetch(new_request, final_callback)
-            self.stream.close()
             return
         if self._decompressor:
             data = (self._decompressor.decompress(data) +
@@ -366,8 +589,8 @@ class _HTTPConnection(object):
                                 request_time=time.time() - self.start_time,
                                 buffer=buffer,
                                 effective_url=self.request.url)
+        self._release_stream()
         self._run_callback(response)
-        self.stream.close()
 
     def _on_chunk_length(self, data):
         # TODO: "chunk extensions" http://tools.ietf.org/html/rfc2616#section-3.6.1
@@ -388,7 +611,11 @@ class _HTTPConnection(object):
                 # all the data has been decompressed, so we don't need to
                 # decompress again in _on_body
                 self._decompressor = None
-            self._on_body(b('').join(self.chunks))
+            if self._keep_alive:
+                # 连接还要复用，所以要把最后一个chunk之后的trailer（通常只有一个空行）读完
+                self.stream.read_until(b("\r\n"), self._on_chunk_trailer)
+            else:
+                self._on_body(b('').join(self.chunks))
         else:
             self.stream.read_bytes(length + 2,  # chunk ends with \r\n
                               self._on_chunk_data)
@@ -404,6 +631,12 @@ class _HTTPConnection(object):
             self.chunks.append(chunk)
         self.stream.read_until(b("\r\n"), self._on_chunk_length)
 
+    def _on_chunk_trailer(self, data):
+        if data == b("\r\n"):
+            self._on_body(b('').join(self.chunks))
+        else: # 忽略trailer中的header
+            self.stream.read_until(b("\r\n"), self._on_chunk_trailer)
+
 
 # match_hostname was added to the standard library ssl module in python 3.2.
 # The following code was backported for older releases and copied from
@@ -10,6 +10,7 @@ import Cookie
 import base64
 import binascii
 import calendar
+import collections
 import datetime
 import email.utils
 import functools
@@ -34,6 +35,7 @@ import urlparse
 import uuid
 
 from tornado import escape
+from tornado import httputil
 from tornado import locale
 from tornado import stack_context
 from tornado import template
@@ -52,6 +54,11 @@ class RequestHandler(object):
     # 如果支持的方法超出了SUPPORTED_METHODS里的范围，则需要在子类中重新定义这个变量。
     SUPPORTED_METHODS = ("GET", "HEAD", "POST", "DELETE", "PATCH", "PUT", "OPTIONS")
 
+    _stream_request_body = False  # set by the stream_request_body decorator
+
+    # 为True时data_received收到的是memoryview而不是字符串（见HTTPConnection.read_body的as_view）
+    data_received_as_view = False
+
     _template_loaders = {}  # {path: template.BaseLoader}
     _template_loader_lock = threading.Lock()
 
@@ -75,7 +82,7 @@ class RequestHandler(object):
         self.clear()
         # Check since connection is not available in WSGI
         if getattr(self.request, "connection", None):
-            self.request.connection.stream.set_close_callback(self.on_connection_close)
+            self.request.connection.set_close_callback(self.on_connection_close, self.request)
         self.initialize(**kwargs)
 
     def initialize(self):
@@ -172,7 +179,9 @@ class RequestHandler(object):
         }
         self._list_headers = []
         self.set_default_headers()
-        if not self.request.supports_http_1_1():
+        if getattr(self.request, "close_connection", False):
+            self.set_header("Connection", "close")
+        elif not self.request.supports_http_1_1():
             if self.request.headers.get("Connection") == "Keep-Alive":
                 self.set_header("Connection", "Keep-Alive")
         self._write_buffer = []
@@ -663,7 +672,7 @@ class RequestHandler(object):
             # set on the IOStream (which would otherwise prevent the
             # garbage collection of the RequestHandler when there
             # are keepalive connections)
-            self.request.connection.stream.set_close_callback(None)
+            self.request.connection.set_close_callback(None, self.request)
 
         if not self.application._wsgi:
             self.flush(include_footers=True)
@@ -982,12 +991,42 @@ class RequestHandler(object):
             if not self._finished:
                 args = [self.decode_argument(arg) for arg in args]
                 kwargs = dict((k, self.decode_argument(v, name=k)) for (k, v) in kwargs.iteritems())
-                getattr(self, self.request.method.lower())(*args, **kwargs)
-                if self._auto_finish and not self._finished:
-                    self.finish()
+                if self._stream_request_body:
+                    if getattr(self.request, "body_streaming", False):
+                        # 请求体全部交给data_received之后才执行get/post等方法
+                        with stack_context.ExceptionStackContext(self._stack_context_handle_exception):
+                            self.request.connection.read_body(
+                                self.data_received, functools.partial(self._execute_method, args, kwargs),
+                                as_view=self.data_received_as_view)
+                        return
+                    if self.request.body: # WSGI等情况下请求体已经在内存中了
+                        self.data_received(self.request.body)
+                self._execute_method(args, kwargs)
         except Exception, e:
             self._handle_request_exception(e)
 
+    def _execute_method(self, args, kwargs):
+        getattr(self, self.request.method.lower())(*args, **kwargs)
+        if self._auto_finish and not self._finished:
+            self.finish()
+
+    def data_received(self, chunk):
+        """Implement this method to handle the request body of handlers
+        decorated with `stream_request_body`.
+
+        Called with each chunk of the body as it arrives, after ``prepare``
+        and before the ``get``/``post``/etc method.  Call
+        ``self.request.connection.pause_reading()`` to stop reading more of
+        the body while a chunk is being processed asynchronously, and
+        ``resume_reading()`` when it is done.
+
+        If the handler sets ``data_received_as_view = True``, ``chunk`` is
+        a ``memoryview`` of the connection's read buffer instead of a
+        string, which saves a copy when the data is only written to a file
+        or another socket.  Call ``chunk.tobytes()`` if a string is needed.
+        """
+        raise NotImplementedError()
+
     def _generate_headers(self):
         lines = [utf8(self.request.version + " " +
                       str(self._status_code) +
@@ -1064,6 +1103,18 @@ def asynchronous(method):
     return wrapper
 
 
+def stream_request_body(cls):
+    """ 修饰RequestHandler的子类，使请求体不再全部读到内存中后才执行handler，而是在收到header后就执行prepare，
+    之后每收到一块请求体调用一次data_received(chunk)，全部收到后再调用get/post等方法。
+    这样上传的大文件可以用固定大小的内存写到磁盘或者转发出去。request.body为空，也不会解析请求体中的参数，
+    所以xsrf_cookies打开时_xsrf只能通过X-Xsrftoken header或者URL参数传递。请求体不受max_buffer_size的限制，
+    需要时在prepare中检查Content-Length。 """
+    if not issubclass(cls, RequestHandler):
+        raise TypeError("expected subclass of RequestHandler, got %r" % cls)
+    cls._stream_request_body = True
+    return cls
+
+
 def removeslash(method):
     """Use this decorator to remove trailing slashes from the request path.
 
@@ -1122,6 +1173,10 @@ class Application(object):
         else:
             self.transforms = transforms
         self.handlers = []
+        self._routers = {} # id(某个host的handlers) -> (handlers, _URLRouter)，保留handlers的引用，它的id不会被重用
+        # settings["route_cache_size"]为0时不缓存路由查找的结果
+        route_cache_size = settings.get("route_cache_size", 1024)
+        self.route_cache = _RouteCache(route_cache_size) if route_cache_size else None
         self.named_handlers = {}
         self.default_host = default_host
         self.settings = settings
@@ -1134,6 +1189,8 @@ class Application(object):
         self._wsgi = wsgi
         self._load_ui_modules(settings.get("ui_modules", {}))
         self._load_ui_methods(settings.get("ui_methods", {}))
+        if isinstance(settings.get("static_manifest"), basestring) and not settings.get("static_path"):
+            raise ValueError("The static_manifest setting requires static_path")
         if self.settings.get("static_path"):
             path = self.settings["static_path"]
             handlers = list(handlers or [])
@@ -1143,6 +1200,23 @@ class Application(object):
             static_handler_args['path'] = path
             for pattern in [re.escape(static_url_prefix) + r"(.*)", r"/(favicon\.ico)", r"/(robots\.txt)"]:
                 handlers.insert(0, (pattern, static_handler_class, static_handler_args))
+            manifest = settings.get("static_manifest")
+            if isinstance(manifest, basestring):
+                # 启动时加载manifest文件，文件不存在或者已经过时（见manifest_is_current）时hash整个static_path
+                # 并重新写入该文件。之后settings["static_manifest"]就是manifest本身，static_url只需查一次dict
+                loaded = None
+                if os.path.exists(manifest):
+                    loaded = static_handler_class.load_manifest(manifest)
+                    if not static_handler_class.manifest_is_current(manifest, loaded, path):
+                        logging.info("Static manifest %s is out of date, rebuilding", manifest)
+                        loaded = None
+                if loaded is not None:
+                    settings["static_manifest"] = loaded
+                else:
+                    built = static_handler_class.build_manifest(
+                        path, executor=settings.get("static_manifest_executor"), manifest_filename=manifest)
+                    static_handler_class.save_manifest(manifest, built)
+                    settings["static_manifest"] = built
         if handlers:
             self.add_handlers(".*$", handlers)
 
@@ -1195,6 +1269,9 @@ class Application(object):
                     kwargs = {}
                 spec = URLSpec(pattern, handler, kwargs)
             handlers.append(spec)
+            self._routers.pop(id(handlers), None)
+            if self.route_cache is not None:
+                self.route_cache.clear()
             if spec.name:
                 if spec.name in self.named_handlers:
                     logging.warning("Multiple handlers named %s; replacing previous value", spec.name)
@@ -1216,6 +1293,57 @@ class Application(object):
                     return handlers
         return None
 
+    def streams_request_body(self, request):
+        """ HTTPServer收到带有请求体的请求的header时调用：处理该请求的handler是否用stream_request_body修饰过。 """
+        found, spec, args, kwargs = self._get_route(request)
+        return spec is not None and getattr(spec.handler_class, "_stream_request_body", False)
+
+    def _get_route(self, request):
+        # 结果保存在request.route上：streams_request_body和__call__对同一个请求只查找一次，route_cache的统计也只计一次。
+        # 不是httpserver.HTTPRequest的请求对象（比如wsgi的）可能没有route属性，这时每次都查找
+        route = getattr(request, "route", None)
+        if route is not None:
+            return route
+        # route_cache按(host, path)缓存查找的结果，命中时不用再匹配host和路由
+        if self.route_cache is None:
+            route = self._find_route(request)
+        else:
+            key = (request.host, request.path, "X-Real-Ip" in request.headers)
+            route = self.route_cache.get(key)
+            if route is None:
+                route = self._find_route(request)
+                self.route_cache.put(key, route)
+        if hasattr(request, "route"):
+            request.route = route
+        return route
+
+    def _find_route(self, request):
+        """ 返回(是否有匹配的host, URLSpec, args, kwargs)，没有匹配的URLSpec时URLSpec为None。 """
+        handlers = self._get_host_handlers(request)
+        if not handlers:
+            return False, None, (), {}
+        spec, match = self._get_router(handlers).match(request.path)
+        if spec is None or not spec.regex.groups:
+            return True, spec, (), {}
+        # None-safe wrapper around url_unescape to handle unmatched optional groups correctly
+        def unquote(s):
+            if s is None:
+                return s
+            return escape.url_unescape(s, encoding=None)
+        # Pass matched groups to the handler.  Since match.groups() includes both named and unnamed groups,
+        # we want to use either groups or groupdict but not both.
+        # Note that args are passed as bytes so the handler can decide what encoding to use.
+        if spec.regex.groupindex:
+            return True, spec, (), dict((str(k), unquote(v)) for (k, v) in match.groupdict().iteritems())
+        return True, spec, tuple(unquote(s) for s in match.groups()), {}
+
+    def _get_router(self, handlers):
+        """ 返回handlers对应的_URLRouter。add_handlers修改handlers时会删掉旧的_URLRouter，下次查找时重新编译。 """
+        entry = self._routers.get(id(handlers))
+        if entry is None:
+            entry = self._routers[id(handlers)] = (handlers, _URLRouter(handlers))
+        return entry[1]
+
     def _load_ui_methods(self, methods):
         if type(methods) is types.ModuleType:
             self._load_ui_methods(dict((n, getattr(methods, n)) for n in dir(methods)))
@@ -1245,34 +1373,13 @@ class Application(object):
     def __call__(self, request): # HTTPServer接收到请求之后的回调函数，request参数是由HTTPServer分析请求后包装出来的
         """ HTTPServer会调用该类的对象以执行一次请求。 """
         transforms = [t(request) for t in self.transforms]
-        handler = None
-        args = []
-        kwargs = {}
-        handlers = self._get_host_handlers(request)
-        if not handlers:
+        found, spec, args, kwargs = self._get_route(request)
+        if not found:
             handler = RedirectHandler(self, request, url="http://" + self.default_host + "/")
+        elif spec is not None:
+            handler = spec.handler_class(self, request, **spec.kwargs)
         else:
-            for spec in handlers:
-                match = spec.regex.match(request.path)
-                if match:
-                    handler = spec.handler_class(self, request, **spec.kwargs)
-                    if spec.regex.groups:
-                        # None-safe wrapper around url_unescape to handle unmatched optional groups correctly
-                        def unquote(s):
-                            if s is None:
-                                return s
-                            return escape.url_unescape(s, encoding=None)
-                        # Pass matched groups to the handler.  Since match.groups() includes both named and unnamed groups,
-                        # we want to use either groups or groupdict but not both.
-                        # Note that args are passed as bytes so the handler can decide what encoding to use.
-
-                        if spec.regex.groupindex:
-                            kwargs = dict((str(k), unquote(v)) for (k, v) in match.groupdict().iteritems())
-                        else:
-                            args = [unquote(s) for s in match.groups()]
-                    break
-            if not handler:
-                handler = ErrorHandler(self, request, status_code=404)
+            handler = ErrorHandler(self, request, status_code=404)
 
         # In debug mode, re-compile templates and reload static files on every request so you don't need to restart to see changes
         if self.settings.get("debug"):
@@ -1383,7 +1490,23 @@ class StaticFileHandler(RequestHandler):
     CACHE_MAX_AGE = 86400 * 365 * 10  # 10 years
 
     _static_hashes = {}
-    _lock = threading.Lock()  # protects _static_hashes
+    _static_etags = {}  # abspath -> ((mtime, size, inode), etag)
+    _lock = threading.Lock()  # protects _static_hashes and _static_etags
+
+    # Set to a `StaticFileCache` to keep small files in memory (shared by
+    # the whole process), e.g. ``StaticFileHandler.file_cache = StaticFileCache()``
+    file_cache = None
+
+    # How the Etag of a file read from disk is computed: "content" (sha1 of
+    # the contents), "stat" (inode, size and mtime; no reads, but differs
+    # between machines) or "manifest" (the md5 from the ``static_manifest``
+    # setting, falling back to "content").  Files in file_cache or
+    # gzip_cache always use the sha1 computed when they were loaded.
+    etag_strategy = "content"
+
+    # Set to a `GzipStaticFileCache` to compress each file once instead of on
+    # every response; precompressed ``foo.js.gz`` files are used first anyway
+    gzip_cache = None
 
     def initialize(self, path, default_filename=None):
         self.root = os.path.abspath(path) + os.path.sep
@@ -1393,6 +1516,11 @@ class StaticFileHandler(RequestHandler):
     def reset(cls):
         with cls._lock:
             cls._static_hashes = {}
+            cls._static_etags = {}
+        if cls.file_cache is not None:
+            cls.file_cache.clear()
+        if cls.gzip_cache is not None:
+            cls.gzip_cache.clear()
 
     def head(self, path):
         self.get(path, include_body=False)
@@ -1404,7 +1532,10 @@ class StaticFileHandler(RequestHandler):
         # it needs to be temporarily added back for requests to root/
         if not (abspath + os.path.sep).startswith(self.root):
             raise HTTPError(403, "%s is not in root static directory", path)
-        if os.path.isdir(abspath) and self.default_filename is not None:
+        # 命中file_cache时不用再访问文件系统（除了每隔revalidate_interval秒的一次stat）
+        stat_result = None
+        cached = self.file_cache.get(abspath) if self.file_cache is not None else None
+        if cached is None and os.path.isdir(abspath) and self.default_filename is not None:
             # need to look at the request.path here for when path is empty
             # but there is some prefix to the path that was already
             # trimmed by the routing
@@ -1412,17 +1543,35 @@ class StaticFileHandler(RequestHandler):
                 self.redirect(self.request.path + "/")
                 return
             abspath = os.path.join(abspath, self.default_filename)
-        if not os.path.exists(abspath):
-            raise HTTPError(404)
-        if not os.path.isfile(abspath):
-            raise HTTPError(403, "%s is not a file", path)
-
-        stat_result = os.stat(abspath)
-        modified = datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME])
+            cached = self.file_cache.get(abspath) if self.file_cache is not None else None
+        if cached is None:
+            if not os.path.exists(abspath):
+                raise HTTPError(404)
+            if not os.path.isfile(abspath):
+                raise HTTPError(403, "%s is not a file", path)
+            stat_result = os.stat(abspath)
+            if self.file_cache is not None:
+                cached = self.file_cache.load(abspath, stat_result)
+        if cached is not None:
+            modified, mime_type, size = cached.modified, cached.mime_type, len(cached.data)
+        else:
+            modified = datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME])
+            mime_type, encoding = mimetypes.guess_type(abspath)
+            size = stat_result[stat.ST_SIZE]
+
+        if mime_type in GZipContentEncoding.CONTENT_TYPES:
+            # 可压缩的类型的响应内容取决于Accept-Encoding。客户端接受gzip时发送压缩过的版本，
+            # 设置了Content-Encoding之后GZipContentEncoding不会再压缩一次
+            self.set_header("Vary", "Accept-Encoding")
+            if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+                variant = self._get_gzip_variant(abspath)
+                if variant is not None:
+                    abspath, cached, stat_result = variant
+                    size = len(cached.data) if cached is not None else stat_result[stat.ST_SIZE]
+                    self.set_header("Content-Encoding", "gzip")
 
         self.set_header("Last-Modified", modified)
 
-        mime_type, encoding = mimetypes.guess_type(abspath)
         if mime_type:
             self.set_header("Content-Type", mime_type)
 
@@ -1437,26 +1586,193 @@ class StaticFileHandler(RequestHandler):
 
         self.set_extra_headers(path)
 
-        # Check the If-Modified-Since, and don't send the result if the
-        # content has not been modified
-        ims_value = self.request.headers.get("If-Modified-Since")
-        if ims_value is not None:
-            date_tuple = email.utils.parsedate(ims_value)
-            if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
-            if if_since >= modified:
+        # If-None-Match优先于If-Modified-Since。两种条件请求都在打开文件之前处理，
+        # 只有etag_strategy为"content"且Etag还没有缓存时才需要读文件
+        etag = None
+        inm_value = self.request.headers.get("If-None-Match")
+        if inm_value is not None:
+            etag = self._compute_etag(abspath, stat_result, cached)
+            if _etag_matches(inm_value, etag):
+                self.set_header("Etag", etag)
                 self.set_status(304)
                 return
+        else:
+            # Check the If-Modified-Since, and don't send the result if the
+            # content has not been modified
+            ims_value = self.request.headers.get("If-Modified-Since")
+            if ims_value is not None:
+                date_tuple = email.utils.parsedate(ims_value)
+                if_since = datetime.datetime.fromtimestamp(time.mktime(date_tuple))
+                if if_since >= modified:
+                    self.set_status(304)
+                    return
 
-        with open(abspath, "rb") as file:
-            data = file.read()
-            hasher = hashlib.sha1()
-            hasher.update(data)
-            self.set_header("Etag", '"%s"' % hasher.hexdigest())
-            if include_body:
-                self.write(data)
+        if etag is None:
+            etag = self._compute_etag(abspath, stat_result, cached)
+        self.set_header("Etag", etag)
+        self.set_header("Accept-Ranges", "bytes")
+
+        # body是要发送的内容：字符串直接发送，(start, end)表示文件中的一段。HEAD请求与GET使用相同的status和header
+        ranges = None
+        range_header = self.request.headers.get("Range")
+        if range_header is not None and self._if_range_matches(etag, modified):
+            ranges = httputil.parse_range_header(range_header, size)
+        if ranges is None:
+            body = [(0, size)]
+        elif not ranges:
+            self.set_status(416)
+            self.set_header("Content-Range", "bytes */%d" % size)
+            return
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_status(206)
+            self.set_header("Content-Range", "bytes %d-%d/%d" % (start, end - 1, size))
+            body = ranges
+        else:
+            boundary = uuid.uuid4().hex
+            self.set_status(206)
+            self.set_header("Content-Type", "multipart/byteranges; boundary=%s" % boundary)
+            body = []
+            for start, end in ranges:
+                part_headers = "\r\n--%s\r\n" % boundary
+                if mime_type:
+                    part_headers += "Content-Type: %s\r\n" % mime_type
+                part_headers += "Content-Range: bytes %d-%d/%d\r\n\r\n" % (start, end - 1, size)
+                body.append(utf8(part_headers))
+                body.append((start, end))
+            body.append(utf8("\r\n--%s--\r\n" % boundary))
+        self.set_header("Content-Length", sum(
+            len(item) if isinstance(item, bytes_type) else item[1] - item[0] for item in body))
+        if not include_body:
+            assert self.request.method == "HEAD"
+            return
+
+        if cached is not None:
+            if ranges is not None and not self.application._wsgi:
+                # 与下面不经过缓存的情况一样先发送header：Content-Range描述的是原始内容，部分内容不能再被gzip等输出变换改写
+                self.flush()
+            for item in body:
+                self.write(item if isinstance(item, bytes_type) else cached.data[item[0]:item[1]])
+            return
+        if self.application._wsgi or (ranges is None and self._body_transformed(mime_type)):
+            # WSGI不支持flush，gzip等输出变换要改写内容，这两种情况只能把文件读到内存中再write
+            with open(abspath, "rb") as file:
+                for item in body:
+                    if isinstance(item, bytes_type):
+                        self.write(item)
+                    else:
+                        file.seek(item[0])
+                        self.write(file.read(item[1] - item[0]))
+            return
+        # 先发送header，再由IOStream.write_file把文件（中请求的部分）发送出去，能用sendfile时数据不经过python。
+        # 有Content-Length且不是finish时，输出变换不会改写内容
+        # 文件保存在self._file上：客户端中途断开时_on_file_sent不会被调用，由on_connection_close关闭
+        self._file = open(abspath, "rb")
+        self.flush()
+        self._auto_finish = False
+        for i, item in enumerate(body):
+            callback = self._on_file_sent if i == len(body) - 1 else None
+            if isinstance(item, bytes_type):
+                self.request.write(item, callback=callback)
             else:
-                assert self.request.method == "HEAD"
-                self.set_header("Content-Length", len(data))
+                self.request.write_file(self._file, item[0], item[1] - item[0], callback=callback)
+
+    def _if_range_matches(self, etag, modified):
+        """ 没有If-Range，或者If-Range中的Etag/日期与当前文件一致时，才按Range只返回部分内容。 """
+        if_range = self.request.headers.get("If-Range")
+        if if_range is None:
+            return True
+        if_range = if_range.strip()
+        if if_range.startswith('"') or if_range.startswith("W/"):
+            return if_range == etag # 弱Etag不能用于If-Range
+        date_tuple = email.utils.parsedate(if_range)
+        if date_tuple is None:
+            return False
+        return datetime.datetime.fromtimestamp(time.mktime(date_tuple)) == modified
+
+    def _get_gzip_variant(self, abspath):
+        """ 返回abspath的gzip压缩版本(路径, 缓存项, stat)，没有时返回None。
+        优先使用与文件放在一起的预压缩文件（foo.js.gz），其次是gzip_cache中压缩过的副本。
+        不检查.gz文件是否比原文件旧，更新文件时应该同时重新生成.gz文件。 """
+        gzip_path = abspath + ".gz"
+        cached = self.file_cache.get(gzip_path) if self.file_cache is not None else None
+        if cached is not None:
+            return gzip_path, cached, None
+        try:
+            stat_result = os.stat(gzip_path)
+        except OSError:
+            stat_result = None
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode):
+            if self.file_cache is not None:
+                cached = self.file_cache.load(gzip_path, stat_result)
+            return gzip_path, cached, stat_result
+        if self.gzip_cache is not None:
+            cached = self.gzip_cache.get(abspath)
+            if cached is None:
+                cached = self.gzip_cache.load(abspath, os.stat(abspath))
+            if cached is not None:
+                return abspath, cached, None
+        return None
+
+    def _on_file_sent(self):
+        self._close_file()
+        self.finish()
+
+    def on_connection_close(self):
+        self._close_file()
+        super(StaticFileHandler, self).on_connection_close()
+
+    def _close_file(self):
+        file = getattr(self, "_file", None)
+        if file is not None:
+            self._file = None
+            file.close()
+
+    def _body_transformed(self, mime_type):
+        """ 输出变换是否会改写文件内容。带有Content-Length时ChunkedTransferEncoding不会分块。 """
+        for transform in self._transforms:
+            if isinstance(transform, ChunkedTransferEncoding):
+                continue
+            if isinstance(transform, GZipContentEncoding) and not (
+                transform._gzipping and mime_type in GZipContentEncoding.CONTENT_TYPES and
+                "Content-Encoding" not in self._headers):
+                continue
+            return True
+        return False
+
+    def _compute_etag(self, abspath, stat_result, cached):
+        """ 按etag_strategy返回文件的Etag。stat_result为None时cached一定不是None。 """
+        if cached is not None:
+            return cached.etag
+        if self.etag_strategy == "stat":
+            mtime, size, inode = _stat_key(stat_result)
+            return '"%x-%x-%x"' % (inode, size, int(mtime * 1000000))
+        if self.etag_strategy == "manifest":
+            manifest = self.settings.get("static_manifest")
+            static_path = self.settings.get("static_path")
+            if isinstance(manifest, dict) and static_path:
+                path = os.path.relpath(abspath, os.path.abspath(static_path))
+                hsh = manifest.get(path.replace(os.path.sep, "/"))
+                if hsh:
+                    return '"%s"' % hsh
+        return self._get_etag(abspath, stat_result)
+
+    @classmethod
+    def _get_etag(cls, abspath, stat_result):
+        """ 返回文件内容的sha1作为Etag。结果按文件的stat信息缓存，文件没有变化时不再读取文件。 """
+        key = _stat_key(stat_result)
+        with cls._lock:
+            cached = cls._static_etags.get(abspath)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        hasher = hashlib.sha1()
+        with open(abspath, "rb") as file:
+            for block in iter(functools.partial(file.read, 64 * 1024), b("")):
+                hasher.update(block)
+        etag = '"%s"' % hasher.hexdigest()
+        with cls._lock:
+            cls._static_etags[abspath] = (key, etag)
+        return etag
 
     def set_extra_headers(self, path):
         """For subclass to add extra headers to the response"""
@@ -1502,7 +1818,15 @@ class StaticFileHandler(RequestHandler):
         is the relative location of the requested asset on the filesystem.
         The returned value should be a string, or ``None`` if no version
         could be determined.
+
+        If the ``static_manifest`` setting is used, the version comes from
+        the manifest without any file I/O; files missing from the manifest
+        get no version.
         """
+        manifest = settings.get("static_manifest")
+        if isinstance(manifest, dict):
+            hsh = manifest.get(path)
+            return hsh[:5] if hsh else None
         abs_path = os.path.join(settings["static_path"], path)
         with cls._lock:
             hashes = cls._static_hashes
@@ -1519,6 +1843,100 @@ class StaticFileHandler(RequestHandler):
                 return hsh[:5]
         return None
 
+    @classmethod
+    def build_manifest(cls, static_path, executor=None, manifest_filename=None, timeout=300):
+        """Hashes every file under ``static_path`` and returns the manifest.
+
+        The manifest is a dict mapping paths relative to ``static_path``
+        (with ``/`` separators, as passed to ``static_url``) to the md5 of
+        the file's contents.  Files that cannot be read are left out, as is
+        ``manifest_filename`` (and its temporary files) if the manifest is
+        saved inside ``static_path``.  If ``executor`` (e.g. a
+        `tornado.executor.ProcessPoolExecutor`) is given the files are
+        hashed in parallel on it; files it has not hashed after
+        ``timeout`` seconds are hashed in this thread instead.  This blocks
+        until all files are hashed, so call it from a build step or at
+        startup, not from the IOLoop.
+        """
+        paths = _list_static_files(static_path, manifest_filename)
+        abs_paths = [os.path.join(static_path, path) for path in paths]
+        if executor is None:
+            hashes = _hash_static_files(abs_paths)
+        else:
+            # 每个任务处理一批文件，任务数量远小于max_queue_size，不会触发ExecutorQueueFull
+            batch_size = max(1, len(abs_paths) // (executor.max_workers * 4) + 1)
+            batches = [abs_paths[i:i + batch_size] for i in xrange(0, len(abs_paths), batch_size)]
+            results = [None] * len(batches)
+            remaining = [len(batches)]
+            lock = threading.Lock()
+            done = threading.Event()
+
+            def on_result(index, result, exc_info):
+                if exc_info is not None:
+                    logging.error("Could not hash static files", exc_info=exc_info)
+                    result = [None] * len(batches[index])
+                with lock:
+                    if done.is_set(): # 已经超时，剩下的批次由当前线程处理了
+                        return
+                    results[index] = result
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        done.set()
+            for i, batch in enumerate(batches):
+                executor.submit(_hash_static_files, (batch,), {},
+                                functools.partial(on_result, i))
+            if batches and not done.wait(timeout):
+                # 进程池的子进程可能已经死掉，结果永远不会到达
+                with lock:
+                    done.set()
+                    missing = [i for i, result in enumerate(results) if result is None]
+                logging.warning("Timed out hashing static files in %r, hashing %d batches inline",
+                                executor, len(missing))
+                for i in missing:
+                    results[i] = _hash_static_files(batches[i])
+            hashes = list(itertools.chain(*results))
+        return dict((path, hsh) for path, hsh in zip(paths, hashes) if hsh is not None)
+
+    @classmethod
+    def load_manifest(cls, filename):
+        """Loads a manifest written by `save_manifest`."""
+        with open(filename, "rb") as f:
+            return escape.json_decode(f.read())
+
+    @classmethod
+    def manifest_is_current(cls, filename, manifest, static_path):
+        """Returns True if ``manifest`` (loaded from ``filename``) still matches ``static_path``.
+
+        The manifest is out of date if files were added or removed, or if
+        any file was modified after ``filename`` was written; the
+        ``static_manifest`` setting then rebuilds it at startup.  Deploys
+        that keep older modification times on changed files should rebuild
+        the manifest as part of the deploy instead.
+        """
+        written = os.stat(filename).st_mtime
+        paths = _list_static_files(static_path, filename)
+        # build_manifest会跳过不能读取的文件，它们不在manifest中不表示manifest过时了
+        if set(manifest) - set(paths):
+            return False
+        for path in paths:
+            abs_path = os.path.join(static_path, path)
+            if path not in manifest:
+                if os.access(abs_path, os.R_OK):
+                    return False
+                continue
+            if os.stat(abs_path).st_mtime > written:
+                return False
+        return True
+
+    @classmethod
+    def save_manifest(cls, filename, manifest):
+        """Writes ``manifest`` (as returned by `build_manifest`) to ``filename`` as JSON."""
+        # 先写临时文件再rename，其他进程不会读到写了一半的manifest
+        tmp_filename = "%s.%d.tmp" % (filename, os.getpid())
+        with open(tmp_filename, "wb") as f:
+            f.write(utf8(escape.json_encode(manifest)))
+        os.rename(tmp_filename, filename)
+
     def parse_url_path(self, url_path):
         """Converts a static URL path into a filesystem path.
 
@@ -1531,6 +1949,181 @@ class StaticFileHandler(RequestHandler):
         return url_path
 
 
+class StaticFileCache(object):
+    """An in-memory LRU cache of small static files for `StaticFileHandler`.
+
+    Holds the contents, ETag, mime type and modification time of files of
+    at most ``max_file_size`` bytes, keyed by absolute path, up to
+    ``max_bytes`` in total.  A cached file is checked against the
+    filesystem (mtime, size and inode) at most once every
+    ``revalidate_interval`` seconds, so changes show up after that delay.
+    ``hits`` and ``misses`` count lookups.
+    """
+    def __init__(self, max_bytes=32 * 1024 * 1024, max_file_size=512 * 1024,
+                 revalidate_interval=2.0):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.revalidate_interval = revalidate_interval
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # 按最近使用的顺序排列，最久没用的在最前面
+        self._total_bytes = 0
+        self._lock = threading.Lock() # WSGI应用中会被多个线程访问
+
+    def get(self, abspath):
+        """ 返回abspath对应的缓存项，没有缓存或者文件已经改变时返回None。 """
+        with self._lock:
+            entry = self._entries.pop(abspath, None)
+        if entry is not None and time.time() - entry.checked > self.revalidate_interval:
+            try:
+                stat_result = os.stat(abspath)
+            except OSError:
+                stat_result = None
+            if stat_result is None or _stat_key(stat_result) != entry.key:
+                with self._lock:
+                    self._total_bytes -= len(entry.data)
+                entry = None
+            else:
+                entry.checked = time.time()
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if abspath in self._entries: # 另一个线程同时load了这个文件
+                self._total_bytes -= len(self._entries.pop(abspath).data)
+            self._entries[abspath] = entry
+        return entry
+
+    def load(self, abspath, stat_result):
+        """ 读取文件并放入缓存，返回缓存项。文件太大时返回None。 """
+        if stat_result[stat.ST_SIZE] > self.max_file_size:
+            return None
+        with open(abspath, "rb") as file:
+            data = file.read(self.max_file_size + 1)
+            stat_result = os.fstat(file.fileno()) # 与读到的内容对应的stat
+        if len(data) > self.max_file_size: # 在stat之后文件变大了
+            return None
+        data = self._encode(data)
+        entry = _CachedStaticFile(
+            data=data,
+            etag='"%s"' % hashlib.sha1(data).hexdigest(),
+            mime_type=mimetypes.guess_type(abspath)[0],
+            modified=datetime.datetime.fromtimestamp(stat_result[stat.ST_MTIME]),
+            key=_stat_key(stat_result))
+        with self._lock:
+            old = self._entries.pop(abspath, None)
+            if old is not None:
+                self._total_bytes -= len(old.data)
+            self._entries[abspath] = entry
+            self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes:
+                evicted_path, evicted = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted.data)
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _encode(self, data):
+        """ 把文件内容转换成要缓存的形式。 """
+        return data
+
+
+class GzipStaticFileCache(StaticFileCache):
+    """A `StaticFileCache` of gzip-compressed copies of static files.
+
+    Set as `StaticFileHandler.gzip_cache`, it compresses each compressible
+    file once (at ``compresslevel``) the first time a client that accepts
+    gzip asks for it, instead of `GZipContentEncoding` compressing it on
+    every response.  ``max_file_size`` limits the uncompressed size of a
+    file and ``max_bytes`` the total compressed size.
+    """
+    def __init__(self, compresslevel=9, **kwargs):
+        super(GzipStaticFileCache, self).__init__(**kwargs)
+        self.compresslevel = compresslevel
+
+    def _encode(self, data):
+        value = BytesIO()
+        # mtime固定为0，使同样的内容总是压缩成同样的结果（Etag也就不变）
+        gzip_file = gzip.GzipFile(mode="wb", fileobj=value, compresslevel=self.compresslevel, mtime=0)
+        gzip_file.write(data)
+        gzip_file.close()
+        return value.getvalue()
+
+
+class _CachedStaticFile(object):
+    __slots__ = ['data', 'etag', 'mime_type', 'modified', 'key', 'checked']
+
+    def __init__(self, data, etag, mime_type, modified, key):
+        self.data = data
+        self.etag = etag
+        self.mime_type = mime_type
+        self.modified = modified
+        self.key = key
+        self.checked = time.time() # 上一次与文件系统核对的时间
+
+
+def _etag_matches(if_none_match, etag):
+    """ If-None-Match中是否有与etag相同的Etag（弱比较，忽略W/前缀）。 """
+    if if_none_match.strip() == "*":
+        return True
+    if etag.startswith("W/"):
+        etag = etag[2:]
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value == etag:
+            return True
+    return False
+
+
+def _list_static_files(static_path, manifest_filename=None):
+    """ 返回static_path下所有文件相对于static_path的路径（以/分隔，与static_url的参数一致），按目录顺序排序。
+    manifest_filename以及save_manifest写入它时使用的临时文件不包括在内。 """
+    if manifest_filename is not None:
+        manifest_filename = os.path.abspath(manifest_filename)
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(static_path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            abs_path = os.path.join(dirpath, filename)
+            if manifest_filename is not None:
+                full_path = os.path.abspath(abs_path)
+                if full_path == manifest_filename or (
+                        full_path.startswith(manifest_filename + ".") and full_path.endswith(".tmp")):
+                    continue
+            paths.append(os.path.relpath(abs_path, static_path).replace(os.path.sep, "/"))
+    return paths
+
+
+def _hash_static_files(abs_paths):
+    """ 返回每个文件内容的md5，不能读取的文件为None。是模块级的函数，所以可以在进程池中运行。 """
+    hashes = []
+    for abs_path in abs_paths:
+        try:
+            hasher = hashlib.md5()
+            with open(abs_path, "rb") as f:
+                for block in iter(functools.partial(f.read, 64 * 1024), b("")):
+                    hasher.update(block)
+            hashes.append(hasher.hexdigest())
+        except (IOError, OSError):
+            logging.error("Could not open static file %r", abs_path)
+            hashes.append(None)
+    return hashes
+
+
+def _stat_key(stat_result):
+    """ 用来判断文件是否改变的stat信息。 """
+    return (stat_result.st_mtime, stat_result.st_size, stat_result.st_ino)
+
+
 class FallbackHandler(RequestHandler):
     """A RequestHandler that wraps another HTTP server callback.
 
@@ -1867,6 +2460,201 @@ class URLSpec(object):
 url = URLSpec
 
 
+class _URLRouter(object):
+    """ 把一个host的URLSpec列表编译成查找结构，结果与按顺序逐个regex.match完全相同（第一个匹配的URLSpec）。
+
+    去掉首尾锚点后没有正则元字符的pattern（如r"/favicon\.ico"）放在dict中按路径直接查找；
+    其他pattern去掉分组后按原来的顺序合并成若干个"(p0)|(p1)|..."形式的正则，一次match就能找出第一个匹配的，
+    match对象的lastindex就是它在合并的正则中的序号。python2的re最多支持100个分组，所以每个合并的正则最多
+    _MAX_COMBINED个pattern。含有反向引用、内联flag等不能合并的pattern单独match。 """
+    _MAX_COMBINED = 90
+
+    def __init__(self, specs):
+        self._size = len(specs)
+        self._literals = {} # 路径 -> (序号, URLSpec)，同一路径只保留第一个
+        self._segments = [] # 按序号排列的(第一个pattern的序号, 合并的正则或None, [(序号, URLSpec)])
+        pending = []
+        for index, spec in enumerate(specs):
+            literal = _literal_pattern(spec.regex.pattern)
+            if literal is not None:
+                self._literals.setdefault(literal, (index, spec))
+                continue
+            stripped = _strip_groups(spec.regex.pattern)
+            if stripped is None:
+                self._flush(pending)
+                self._segments.append((index, None, [(index, spec)]))
+                continue
+            pending.append((index, spec, stripped))
+            if len(pending) == self._MAX_COMBINED:
+                self._flush(pending)
+        self._flush(pending)
+
+    def _flush(self, pending):
+        if pending:
+            regex = re.compile("|".join("(%s)" % stripped for index, spec, stripped in pending))
+            self._segments.append((pending[0][0], regex, [(index, spec) for index, spec, stripped in pending]))
+            del pending[:]
+
+    def match(self, path):
+        """ 返回(URLSpec, match对象)，URLSpec的regex中没有分组时match对象为None。没有匹配时返回(None, None)。 """
+        if "\n" in path:
+            # "$"也能匹配结尾的换行符，dict查找做不到，这种路径少见，直接逐个match
+            return self._match_linear(path)
+        literal_index, spec = self._literals.get(path, (self._size, None))
+        for first_index, regex, specs in self._segments:
+            if first_index > literal_index:
+                break
+            if regex is not None:
+                match = regex.match(path)
+                if match is None:
+                    continue
+                index, dynamic_spec = specs[match.lastindex - 1]
+            else:
+                index, dynamic_spec = specs[0]
+                if not dynamic_spec.regex.match(path):
+                    continue
+            if index < literal_index:
+                spec = dynamic_spec
+            break
+        if spec is None or not spec.regex.groups:
+            return spec, None
+        return spec, spec.regex.match(path)
+
+    def _match_linear(self, path):
+        specs = sorted(self._literals.values() +
+                       [item for first_index, regex, specs in self._segments for item in specs])
+        for index, spec in specs:
+            match = spec.regex.match(path)
+            if match:
+                return spec, match if spec.regex.groups else None
+        return None, None
+
+
+class _RouteCache(object):
+    """ Application中(host, path)到路由查找结果的LRU缓存，最多max_entries项。
+
+    缓存满了以后，新的key只有在最近出现的次数比将被淘汰的项多时才会放入缓存（TinyLFU式的准入），
+    所以大量只出现一两次的路径（带id的URL、扫描器等）不会把常用的路径挤出去。
+    出现次数按key计数，计数的样本数达到sample_size后全部减半，使计数反映的是最近的访问频率。
+    hits、misses和rejected（没能放入缓存的次数）是统计信息。 """
+    def __init__(self, max_entries, sample_size=None):
+        self.max_entries = max_entries
+        self.sample_size = sample_size or max_entries * 10
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self._entries = collections.OrderedDict()
+        self._frequency = {}
+        self._samples = 0
+        self._lock = threading.Lock() # WSGIApplication会在多个线程中被调用
+
+    def get(self, key):
+        with self._lock:
+            self._frequency[key] = self._frequency.get(key, 0) + 1
+            self._samples += 1
+            if self._samples >= self.sample_size:
+                self._age()
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                victim = next(iter(self._entries))
+                if self._frequency.get(key, 0) <= self._frequency.get(victim, 0):
+                    self.rejected += 1
+                    return
+                del self._entries[victim]
+            self._entries[key] = value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _age(self):
+        """ 把所有计数减半，丢掉减到0的，计数的dict的大小也因此有上限。 """
+        self._frequency = dict((key, count // 2) for key, count in self._frequency.iteritems() if count > 1)
+        self._samples //= 2
+
+
+def _literal_pattern(pattern):
+    """ pattern只匹配一个固定的路径时返回这个路径，否则返回None。 """
+    if pattern.startswith("^"):
+        pattern = pattern[1:]
+    # 末尾的$前面有奇数个反斜杠时是被转义的字符，这样的pattern只匹配前缀
+    if not pattern.endswith("$") or (len(pattern) - len(pattern[:-1].rstrip("\\")) - 1) % 2:
+        return None
+    pattern = pattern[:-1]
+    chars = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            c = pattern[i + 1:i + 2]
+            if not c or c.isalnum():
+                return None
+            i += 1
+        elif c in ".^$*+?{}[]|()":
+            return None
+        chars.append(c)
+        i += 1
+    return "".join(chars)
+
+
+def _strip_groups(pattern):
+    """ 把pattern中的分组都改成不捕获的(?:...)，不能这样做（有反向引用、内联flag等）时返回None。 """
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            if pattern[i + 1:i + 2].isdigit():
+                return None
+            out.append(pattern[i:i + 2])
+            i += 2
+        elif c == "[":
+            # 字符集合中的括号不是分组，紧跟在[或[^后的]是普通字符
+            end = i + 1
+            if pattern[end:end + 1] == "^":
+                end += 1
+            if pattern[end:end + 1] == "]":
+                end += 1
+            while end < len(pattern) and pattern[end] != "]":
+                end += 2 if pattern[end] == "\\" else 1
+            out.append(pattern[i:end + 1])
+            i = end + 1
+        elif c == "(":
+            if pattern[i + 1:i + 2] != "?":
+                out.append("(?:")
+                i += 1
+            elif pattern.startswith("(?P<", i):
+                out.append("(?:")
+                i = pattern.index(">", i) + 1
+            elif pattern[i:i + 3] in ("(?:", "(?=", "(?!") or pattern[i:i + 4] in ("(?<=", "(?<!"):
+                out.append(c)
+                i += 1
+            else:
+                return None
+        else:
+            out.append(c)
+            i += 1
+    stripped = "".join(out)
+    try:
+        if re.compile(stripped).groups:
+            return None
+    except re.error:
+        return None
+    return stripped
+
+
 def _time_independent_equals(a, b):
     if len(a) != len(b):
         return False